@@ -0,0 +1,193 @@
+"""Compare the frame codecs of frame_codecs.py by size and speed.
+
+Every codec encodes and decodes the same wind frames, by default the levels of a
+synthetic field remapped to the destination grid of extract.py (see synthetic.py),
+or the frames of a previous run of extract.py:
+
+    python benchmarks/bench_codecs.py --model ch2 --levels 20
+    python benchmarks/bench_codecs.py --frames 'data/ch1/CH1-CTRL-Z*-wind.png'
+    python benchmarks/bench_codecs.py --codecs png --png-variants
+
+Reported per codec are the encode and decode time and the size per frame, the
+largest difference to the input in m/s, and an end-to-end time per frame of
+encode, transfer at --bandwidth and decode. PNG and WebP are decoded through GDAL
+here, browsers use their own decoders. With --png-variants, the PNG encoders of
+extract.py are compared as well: the GDAL driver, and frame_codecs.encode_png with
+every compression level, strategy and scanline filter.
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import warnings
+import zlib
+
+import numpy as np
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import extract
+import frame_codecs
+import regrid
+import synthetic
+from bench_regrid import get_commit
+
+
+def make_frames(model, levels, scale):
+    grid = synthetic.Grid(model)
+    destination = synthetic.get_destination(scale)
+    field_U = synthetic.make_field(grid, 'U', levels, seed=0)
+    field_V = synthetic.make_field(grid, 'V', levels, seed=1)
+    chunk_size = extract.remap_memory_budget // extract.weights_bytes_per_point
+    indices, weights, _, _ = regrid.iconremap_delauny(field_U, destination, chunk_size=chunk_size)
+    f_U = regrid.icon2regular(field_U, destination, indices, weights).values
+    f_V = regrid.icon2regular(field_V, destination, indices, weights).values
+    return list(zip(f_U, f_V))
+
+
+def read_frames(pattern):
+    filenames = sorted(glob.glob(pattern))
+    if not filenames:
+        raise FileNotFoundError(f'No frames match {pattern}')
+    frames = []
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            frames.append(frame_codecs.decode_rgba(f.read()))
+    return frames
+
+
+def get_png_variants(folder):
+    def encode_rasterio(u, v):
+        filename = f'{folder}/frame.png'
+        extract.save_png(xr.DataArray(u), xr.DataArray(v), filename)
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    variants = {'png rasterio': frame_codecs.Codec('png', encode_rasterio, frame_codecs.decode_rgba)}
+    strategies = {
+        'default': zlib.Z_DEFAULT_STRATEGY,
+        'filtered': zlib.Z_FILTERED,
+        'rle': zlib.Z_RLE,
+    }
+    for level in [1, 6, 9]:
+        for strategy_name, strategy in strategies.items():
+            for filter_type in [0, 1, 2]:
+                def encode(u, v, level=level, strategy=strategy, filter_type=filter_type):
+                    return frame_codecs.encode_png(u, v, level, strategy, filter_type)
+                name = f'png l{level} {strategy_name} f{filter_type}'
+                variants[name] = frame_codecs.Codec('png', encode, frame_codecs.decode_rgba)
+    return variants
+
+
+def max_error(frame, decoded):
+    errors = []
+    for values, decoded_values in zip(frame, decoded):
+        if not np.array_equal(np.isnan(values), np.isnan(decoded_values)):
+            return float('inf')
+        errors.append(np.nanmax(np.abs(values - decoded_values), initial=0.0))
+    return float(max(errors))
+
+
+def measure(codec, frames, repeat):
+    encode_times = []
+    decode_times = []
+    sizes = []
+    error = 0.0
+    for u, v in frames:
+        data = codec.encode(u, v)
+        decoded = codec.decode(data)
+        error = max(error, max_error((u, v), decoded))
+        sizes.append(len(data))
+        for _ in range(repeat):
+            tic = time.perf_counter()
+            codec.encode(u, v)
+            encode_times.append(time.perf_counter() - tic)
+            tic = time.perf_counter()
+            codec.decode(data)
+            decode_times.append(time.perf_counter() - tic)
+    return statistics.median(encode_times), statistics.median(decode_times), statistics.mean(sizes), error
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='ch2', choices=list(synthetic.cells))
+    parser.add_argument('--levels', type=int, default=extract.levels_per_task, help='number of synthetic frames')
+    parser.add_argument('--scale', type=float, default=1, help='destination resolution relative to the one of extract.py')
+    parser.add_argument('--frames', help='glob of PNG frames written by extract.py, instead of synthetic frames')
+    parser.add_argument('--codecs', nargs='+', help='only run these codecs')
+    parser.add_argument('--png-variants', action='store_true', help='also run the PNG encoder variants of extract.py')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--bandwidth', type=float, default=10, help='transfer bandwidth in MB/s for the end-to-end time')
+    parser.add_argument('--output', help='result file, by default in benchmarks/results')
+    args = parser.parse_args()
+
+    # The frames are not georeferenced, which rasterio warns about on every write
+    warnings.filterwarnings('ignore', category=UserWarning, module='rasterio')
+
+    if args.frames:
+        frames = read_frames(args.frames)
+        print(f'{len(frames)} frames from {args.frames}')
+    else:
+        frames = make_frames(args.model, list(range(1, args.levels + 1)), args.scale)
+        print(f'{len(frames)} synthetic {args.model} frames')
+    ny, nx = frames[0][0].shape
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        codecs = {name: frame_codecs.get_codec(name) for name in args.codecs or frame_codecs.codecs}
+        if args.png_variants:
+            codecs.update(get_png_variants(folder))
+        for name, codec in codecs.items():
+            encode_time, decode_time, size, error = measure(codec, frames, args.repeat)
+            end_to_end = encode_time + size / (args.bandwidth * 1e6) + decode_time
+            results.append({
+                'codec': name,
+                'frames': len(frames),
+                'nx': nx,
+                'ny': ny,
+                'encode_s': encode_time,
+                'decode_s': decode_time,
+                'bytes': size,
+                'max_error': error,
+                'end_to_end_s': end_to_end,
+            })
+
+    width = max(len('codec'), *(len(r['codec']) for r in results))
+    png_size = next((r['bytes'] for r in results if r['codec'] == 'png'), None)
+    print(f'{"codec":<{width}} {"encode ms":>10} {"decode ms":>10} {"bytes":>10} {"vs png":>7} {"error m/s":>10} {"e2e ms":>8}')
+    for r in results:
+        ratio = f'{r["bytes"] / png_size:7.2f}' if png_size else f'{"":7}'
+        print(f'{r["codec"]:<{width}} {r["encode_s"] * 1e3:10.2f} {r["decode_s"] * 1e3:10.2f} {r["bytes"]:10.0f} {ratio} '
+              f'{r["max_error"]:10.3f} {r["end_to_end_s"] * 1e3:8.2f}')
+
+    date = datetime.datetime.now(datetime.timezone.utc)
+    commit = get_commit()
+    output = args.output
+    if output is None:
+        results_folder = os.path.join(os.path.dirname(__file__), 'results')
+        os.makedirs(results_folder, exist_ok=True)
+        output = os.path.join(results_folder, f'codecs-{date:%Y%m%dT%H%M%S}-{commit}.json')
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'date': date.isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'frames': args.frames or f'synthetic {args.model} x{args.scale}',
+            'repeat': args.repeat,
+            'bandwidth': args.bandwidth,
+            'results': results,
+        }, f, indent=2)
+    print(f'Results written to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""Run the extract.py loop end to end against the local stand-in OGD server.
+
+Every run goes through discovery, download, height fields, the horizon pipeline and
+publish of every model, like one iteration of the main loop of extract.py: one
+pipeline per model, sharing one process pool through extract.Scheduler. All paths
+point to a temporary folder, the OGD API to ogd_server.py. The stages are timed by
+extract.py itself, in the main process and in the pipeline workers, and read back
+from the metrics it appends to metrics/extract.jsonl to be summarised per stage and
+per worker:
+
+    python benchmarks/bench_pipeline.py --grid ch2 --horizons 4 --levels 20 --runs 2
+    python benchmarks/bench_pipeline.py --models ch1 ch2 --grid ch2 --horizons 4
+
+The first run computes the remap weights and height fields, later runs reuse them.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import extract
+import ogd_server
+import synthetic
+from meteodatalab import ogd_api
+
+def run_once(models):
+    # Without a manifest, every model is processed again
+    for model in models:
+        extract.delete_all_files_in_folder(extract.get_data_folder(model))
+
+    tic = time.time()
+    num_workers = extract.get_num_workers()
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        extract.start_workers(executor, num_workers)
+        scheduler = extract.Scheduler(executor, num_workers)
+        with ThreadPoolExecutor(max_workers=len(models)) as threads:
+            futures = [
+                threads.submit(extract.run_latest, model, False, 0, num_workers, scheduler, priority)
+                for priority, model in enumerate(models)
+            ]
+            for future in futures:
+                future.result()
+    time_to_publish = time.time() - tic
+    return time_to_publish, num_workers
+
+
+def read_metrics():
+    # One record per model, appended by extract.write_metrics after its publish
+    try:
+        with open(f'{extract.metrics_path}/extract.jsonl') as f:
+            return [json.loads(line) for line in f]
+    except FileNotFoundError:
+        return []
+
+
+def summarise(records, time_to_publish, num_workers):
+    stages = {}
+    workers = {}
+    for record in records:
+        for stage, metric in record['stages'].items():
+            total = stages.setdefault(stage, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            total['calls'] += metric['calls']
+            total['seconds'] += metric['seconds']
+            total['max_seconds'] = max(total['max_seconds'], metric['max_seconds'])
+        # The models share the pool, so a worker may appear in every record
+        for pid, metric in record['workers'].items():
+            worker = workers.setdefault(pid, {'tasks': 0, 'busy_s': 0.0})
+            worker['tasks'] += metric['tasks']
+            worker['busy_s'] += metric['busy_seconds']
+
+    print(f'{"stage":<20} {"calls":>6} {"total s":>9} {"mean ms":>9} {"max ms":>9}')
+    summary = {}
+    for stage, metric in stages.items():
+        summary[stage] = {
+            'calls': metric['calls'],
+            'total_s': metric['seconds'],
+            'mean_s': metric['seconds'] / metric['calls'],
+            'max_s': metric['max_seconds'],
+        }
+        print(f'{stage:<20} {metric["calls"]:6d} {metric["seconds"]:9.2f} {1e3 * metric["seconds"] / metric["calls"]:9.1f} '
+              f'{1e3 * metric["max_seconds"]:9.1f}')
+
+    # The pipelines of the models run at the same time
+    pipeline_seconds = max(record['pipeline_seconds'] for record in records)
+    for pid, worker in sorted(workers.items()):
+        worker['utilisation'] = worker['busy_s'] / pipeline_seconds
+        print(f'worker {pid:<8} {worker["tasks"]:4d} tasks {worker["busy_s"]:8.2f} s busy {100 * worker["utilisation"]:5.1f} %')
+
+    models = {}
+    for record in records:
+        models[record['model']] = {
+            'frames': record['frames'],
+            'frames_per_second': record['frames_per_second'],
+            'download_bytes': record.get('download_bytes', 0),
+            'time_to_publish_s': record['time_to_publish_seconds'],
+        }
+        print(f'{record["model"]}: {record["frames"]} frames, {record["frames_per_second"]:.2f} frames/s, '
+              f'{record.get("download_bytes", 0) / 1e6:.1f} MB downloaded, '
+              f'time to publish {record["time_to_publish_seconds"]:.2f} s')
+
+    frames = sum(record['frames'] for record in records)
+    fps = frames / pipeline_seconds
+    print(f'{frames} frames with {num_workers} workers, {fps:.2f} frames/s, time to publish {time_to_publish:.2f} s')
+    return {
+        'stages': summary,
+        'workers': workers,
+        'models': models,
+        'frames': frames,
+        'num_workers': num_workers,
+        'frames_per_second': fps,
+        'time_to_publish_s': time_to_publish,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ogd_server.add_arguments(parser)
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--workers', type=int, help='size of the process pool, by default from get_num_workers')
+    parser.add_argument('--output', help='write the summary of every run to this JSON file')
+    parser.add_argument('--keep', action='store_true', help='keep the generated assets and outputs')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='bench-pipeline-')
+    levels = list(range(1, args.levels + 1))
+    horizons = [timedelta(hours=h) for h in range(args.horizons)]
+    reference_datetime = ogd_server.get_reference_datetime()
+
+    tic = time.perf_counter()
+    for model in args.models:
+        print(f'Generate {model} run {reference_datetime} with {args.horizons} horizons and {args.levels} levels...')
+        ogd_server.generate(f'{folder}/ogd', model, synthetic.Grid(args.grid or model), reference_datetime, horizons,
+                            levels, args.members)
+    print(f'Generated in {time.perf_counter() - tic:.1f} s')
+
+    bandwidth = args.bandwidth * 1e6 if args.bandwidth else None
+    server = ogd_server.start(f'{folder}/ogd', args.models, reference_datetime, horizons,
+                              latency_s=args.latency_ms / 1e3, bandwidth=bandwidth, members=args.members)
+    host, port = server.server_address[:2]
+    ogd_api.API_URL = f'http://{host}:{port}'
+
+    # Relative paths of extract.py resolve in the working folder, the published
+    # copies go there as well
+    os.makedirs(f'{folder}/work', exist_ok=True)
+    os.chdir(f'{folder}/work')
+    extract.data_copy_path = f'{folder}/work/data-copy/'
+    extract.publish_path = f'{folder}/work/runs'
+    extract.z_values = range(1, args.levels + 1)
+    extract.get_horizons = lambda model: horizons
+    extract.models = args.models
+    extract.ensemble_output = args.members > 0
+    extract.metrics_jsonl = True
+    if args.workers is not None:
+        extract.max_workers = args.workers
+
+    results = []
+    for run in range(args.runs):
+        # The metrics of earlier runs are appended to the same file
+        previous_records = len(read_metrics())
+        time_to_publish, num_workers = run_once(args.models)
+
+        records = read_metrics()[previous_records:]
+        print(f'\nRun {run + 1}/{args.runs}:')
+        results.append(summarise(records, time_to_publish, num_workers))
+        print()
+
+    server.shutdown()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'runs': results}, f, indent=2)
+        print(f'Results written to {args.output}')
+    if args.keep:
+        print(f'Outputs kept in {folder}')
+    else:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
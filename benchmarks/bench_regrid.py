@@ -0,0 +1,177 @@
+"""Time the regrid kernels on synthetic CH1 and CH2 grids.
+
+Runs fully offline, see synthetic.py. Every kernel is timed over several repeats and
+run once more under tracemalloc for its peak memory. The results are stored as JSON
+so that a later run can be compared against them:
+
+    python benchmarks/bench_regrid.py --models ch2 --scales 1 2
+    python benchmarks/bench_regrid.py --compare benchmarks/results/<previous>.json
+
+The peak memory covers the allocations traced by Python and numpy, not the memory
+used internally by qhull or GDAL. The frame encoders are compared in bench_codecs.py.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from pyproj import Transformer
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import extract
+import regrid
+import synthetic
+
+
+def project(lon, lat, crs):
+    transformer = Transformer.from_crs(crs, 'epsg:32632', always_xy=True)
+    return np.array(transformer.transform(lon, lat)).T
+
+
+def get_kernels(model, scale, levels):
+    grid = synthetic.Grid(model)
+    destination = synthetic.get_destination(scale)
+    field = synthetic.make_field(grid, 'U', levels)
+    rotated = synthetic.make_rotated_field(model, 'U', levels)
+    src = regrid.RegularGrid.from_field(rotated)
+
+    # Points in UTM as prepared by iconremap
+    xy = project(grid.lon, grid.lat, 'epsg:4326')
+    gx, gy = np.meshgrid(destination.x, destination.y)
+    uv = project(gx.ravel(), gy.ravel(), destination.crs.wkt)
+
+    chunk_size = extract.remap_memory_budget // extract.weights_bytes_per_point
+    indices, weights, lon, lat = regrid.iconremap_delauny(field, destination, chunk_size=chunk_size)
+    operator = regrid.remap_operator(indices, weights, grid.ncells)
+    remap_chunk_size = max(1, extract.remap_memory_budget // (extract.remap_bytes_per_point * len(levels)))
+
+    return {
+        'linear_weights': lambda: regrid._linear_weights(xy, uv),
+        'linear_weights_cropped_domain': lambda: regrid._linear_weights_cropped_domain(xy, uv),
+        'iconremap_delauny': lambda: regrid.iconremap_delauny(field, destination, chunk_size=chunk_size),
+        'remap_operator': lambda: regrid.remap_operator(indices, weights, grid.ncells),
+        'icon2regular': lambda: regrid.icon2regular(field, destination, indices, weights, chunk_size=remap_chunk_size),
+        'icon2regular_sparse': lambda: regrid.icon2regular(field, destination, indices, weights, operator, remap_chunk_size),
+        'regrid': lambda: regrid.regrid(rotated, destination, regrid.Resampling.bilinear, src),
+    }, destination
+
+
+def measure(kernel, repeat):
+    kernel()
+    times = []
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        kernel()
+        times.append(time.perf_counter() - tic)
+
+    tracemalloc.start()
+    kernel()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(times), statistics.median(times), peak
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, baseline_filename, threshold):
+    with open(baseline_filename) as f:
+        baseline = json.load(f)
+    key = lambda r: (r['kernel'], r['model'], r['scale'], r['levels'])
+    previous = {key(r): r for r in baseline['results']}
+
+    regressions = 0
+    print(f'\nCompared to {baseline["commit"]} ({baseline["date"]}):')
+    for r in results:
+        p = previous.get(key(r))
+        if p is None:
+            continue
+        time_ratio = r['time_min'] / p['time_min']
+        memory_ratio = r['peak_bytes'] / max(1, p['peak_bytes'])
+        regression = time_ratio > threshold or memory_ratio > threshold
+        regressions += regression
+        print(f'{r["kernel"]:<30} {r["model"]} x{r["scale"]:<4} time {time_ratio:6.2f}x memory {memory_ratio:6.2f}x'
+              f'{"  REGRESSION" if regression else ""}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--models', nargs='+', default=['ch2', 'ch1'], choices=list(synthetic.cells))
+    parser.add_argument('--scales', nargs='+', type=float, default=[0.5, 1, 2],
+                        help='destination resolution relative to the one of extract.py')
+    parser.add_argument('--levels', type=int, default=extract.levels_per_task)
+    parser.add_argument('--kernels', nargs='+', help='only run these kernels')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='result file, by default in benchmarks/results')
+    parser.add_argument('--compare', help='result file of a previous run')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='time or memory ratio to the previous run reported as a regression')
+    args = parser.parse_args()
+
+    levels = list(range(1, args.levels + 1))
+    results = []
+    for model in args.models:
+        for scale in args.scales:
+            kernels, destination = get_kernels(model, scale, levels)
+            print(f'{model} {synthetic.cells[model]} cells -> {destination.nx}x{destination.ny}, {len(levels)} levels')
+            for name, kernel in kernels.items():
+                if args.kernels and name not in args.kernels:
+                    continue
+                time_min, time_median, peak = measure(kernel, args.repeat)
+                print(f'  {name:<30} {time_min * 1e3:10.1f} ms {time_median * 1e3:10.1f} ms median {peak / 2**20:8.1f} MiB')
+                results.append({
+                    'kernel': name,
+                    'model': model,
+                    'scale': scale,
+                    'levels': len(levels),
+                    'cells': synthetic.cells[model],
+                    'nx': destination.nx,
+                    'ny': destination.ny,
+                    'time_min': time_min,
+                    'time_median': time_median,
+                    'peak_bytes': peak,
+                })
+
+    date = datetime.datetime.now(datetime.timezone.utc)
+    commit = get_commit()
+    output = args.output
+    if output is None:
+        results_folder = os.path.join(os.path.dirname(__file__), 'results')
+        os.makedirs(results_folder, exist_ok=True)
+        output = os.path.join(results_folder, f'regrid-{date:%Y%m%dT%H%M%S}-{commit}.json')
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'date': date.isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'cpus': os.cpu_count(),
+            'repeat': args.repeat,
+            'results': results,
+        }, f, indent=2)
+    print(f'Results written to {output}')
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+"""Local stand-in for the MeteoSwiss OGD STAC API with synthetic ICON GRIB2 assets.
+
+Generates one forecast run on a synthetic grid (see synthetic.py) and serves the
+subset of the API used by extract.py and meteodatalab.ogd_api:
+
+    POST /search                       STAC item search with the forecast extension
+    GET  /collections/<id>/assets      horizontal and vertical constants
+    GET  /assets/<filename>            asset download, with HEAD, Range and SHA-256 support
+
+    python benchmarks/ogd_server.py --models ch1 ch2 --horizons 4 --levels 20
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(__file__))
+import synthetic
+
+duration_pattern = re.compile(r'P(?:(?P<days>\d+)D)?(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?(?:(?P<seconds>[\d.]+)S)?)?$')
+
+
+def parse_duration(value):
+    match = duration_pattern.match(value)
+    if match is None:
+        raise ValueError(f'Unable to parse duration: {value}')
+    return datetime.timedelta(**{k: float(v) for k, v in match.groupdict().items() if v is not None})
+
+
+def parse_datetime(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc)
+
+
+def get_asset_filename(model, variable, reference_datetime, horizon, perturbed=False):
+    hours = int(horizon.total_seconds() // 3600)
+    return f'icon-{model}-eps-{reference_datetime:%Y%m%d%H%M}-{hours}-{variable.lower()}-{"perturb" if perturbed else "ctrl"}.grib2'
+
+
+def get_constants_filename(model, prefix):
+    return f'{prefix}_constants_icon-{model}-eps.grib2'
+
+
+def generate(folder, model, grid, reference_datetime, horizons, levels, members=0):
+    """Write the constants and the U and V assets of one run to folder.
+
+    With members, the perturbed members of every horizon are written to a second
+    asset, like the ensemble assets of the OGD API.
+    """
+    os.makedirs(folder, exist_ok=True)
+
+    with open(f'{folder}/{get_constants_filename(model, "horizontal")}', 'wb') as f:
+        # Full precision, the coordinates are used to triangulate the grid
+        for variable, values in [('CLON', grid.lon), ('CLAT', grid.lat)]:
+            synthetic.write_grib(f, grid, variable, [values], [0], type_of_level='surface', bits_per_value=32)
+
+    # Half levels from the model top down to the surface, which rises towards the Alps
+    half_levels = list(range(1, len(levels) + 2))
+    surface = 500 + 1500 * np.exp(-((grid.lon - 8.5) ** 2 + (grid.lat - 46.5) ** 2))
+    depth = 22000 * (1 - np.linspace(0, 1, len(half_levels))[:, None]) ** 2
+    with open(f'{folder}/{get_constants_filename(model, "vertical")}', 'wb') as f:
+        synthetic.write_grib(f, grid, 'HHL', surface + depth, half_levels, type_of_level='generalVertical')
+
+    for i, horizon in enumerate(horizons):
+        step = int(horizon.total_seconds() // 3600)
+        for variable, phase in [('U', 0.0), ('V', np.pi / 2)]:
+            filename = f'{folder}/{get_asset_filename(model, variable, reference_datetime, horizon)}'
+            with open(filename, 'wb') as f:
+                values = grid.values(levels, phase=phase + i / 10, seed=i)
+                synthetic.write_grib(f, grid, variable, values, levels, reference_datetime, step)
+            if not members:
+                continue
+            filename = f'{folder}/{get_asset_filename(model, variable, reference_datetime, horizon, perturbed=True)}'
+            with open(filename, 'wb') as f:
+                for member in range(1, members + 1):
+                    values = grid.values(levels, phase=phase + i / 10 + member / 20, seed=members * i + member)
+                    synthetic.write_grib(f, grid, variable, values, levels, reference_datetime, step, member=member)
+
+
+class Catalog:
+    def __init__(self, folder, model, reference_datetime, horizons, members=0):
+        self.folder = folder
+        self.members = members
+        self.model = model
+        self.reference_datetime = reference_datetime
+        self.horizons = horizons
+        self.collection = f'ch.meteoschweiz.ogd-forecasting-icon-{model}'
+
+    def search(self, body):
+        perturbed = body.get('forecast:perturbed', False)
+        if body.get('collections') != [self.collection] or (perturbed and not self.members):
+            return []
+
+        reference_datetime = body.get('forecast:reference_datetime', '')
+        start, _, end = reference_datetime.partition('/')
+        if end:
+            if start != '..' and self.reference_datetime < parse_datetime(start):
+                return []
+            if end != '..' and self.reference_datetime > parse_datetime(end):
+                return []
+        elif parse_datetime(start) != self.reference_datetime:
+            return []
+
+        horizons = self.horizons
+        if 'forecast:horizon' in body:
+            horizon = parse_duration(body['forecast:horizon'])
+            horizons = [h for h in horizons if h == horizon]
+
+        variables = [body['forecast:variable']] if 'forecast:variable' in body else ['U', 'V']
+        return [
+            get_asset_filename(self.model, variable, self.reference_datetime, horizon, perturbed)
+            for horizon in horizons
+            for variable in variables
+        ]
+
+
+def make_handler(catalogs, latency_s=0.0, bandwidth=None):
+    # One catalog per model, all assets are in the same folder
+    folder = catalogs[0].folder
+    # SHA-256 per asset, sent like the X-Amz-Meta-Sha256 metadata of the S3 bucket
+    checksums = {}
+    checksums_lock = threading.Lock()
+
+    def get_checksum(filename):
+        with checksums_lock:
+            if filename not in checksums:
+                with open(filename, 'rb') as f:
+                    checksums[filename] = hashlib.sha256(f.read()).hexdigest()
+            return checksums[filename]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def base_url(self):
+            host, port = self.server.server_address[:2]
+            return f'http://{host}:{port}'
+
+        def do_POST(self):
+            time.sleep(latency_s)
+            if self.path.rstrip('/') != '/search':
+                return self.respond_json(404, {'error': 'Not found'})
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            features = [
+                {
+                    'id': filename.removesuffix('.grib2'),
+                    'assets': {filename: {'href': f'{self.base_url()}/assets/{filename}'}},
+                }
+                for catalog in catalogs
+                for filename in catalog.search(body)
+            ]
+            self.respond_json(200, {'type': 'FeatureCollection', 'features': features, 'links': []})
+
+        def do_HEAD(self):
+            self.do_GET(head=True)
+
+        def do_GET(self, head=False):
+            time.sleep(latency_s)
+            match = re.fullmatch(r'/collections/([^/]+)/assets', self.path)
+            if match:
+                catalog = next((c for c in catalogs if c.collection == match.group(1)), None)
+                if catalog is None:
+                    return self.respond_json(404, {'error': 'Not found'})
+                assets = [
+                    {'id': filename, 'href': f'{self.base_url()}/assets/{filename}'}
+                    for filename in [
+                        get_constants_filename(catalog.model, 'horizontal'),
+                        get_constants_filename(catalog.model, 'vertical'),
+                    ]
+                ]
+                return self.respond_json(200, {'assets': assets})
+
+            match = re.fullmatch(r'/assets/([\w.-]+)', self.path)
+            if not match or not os.path.isfile(f'{folder}/{match.group(1)}'):
+                return self.respond_json(404, {'error': 'Not found'})
+            self.send_asset(f'{folder}/{match.group(1)}', head)
+
+        def send_asset(self, filename, head):
+            size = os.path.getsize(filename)
+            start, end = 0, size - 1
+            match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+            if match:
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else end
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('X-Amz-Meta-Sha256', get_checksum(filename))
+            self.end_headers()
+            if head:
+                return
+
+            with open(filename, 'rb') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = f.read(min(remaining, 1 << 20))
+                    if not chunk:
+                        break
+                    tic = time.perf_counter()
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+                    if bandwidth is not None:
+                        time.sleep(max(0.0, len(chunk) / bandwidth - (time.perf_counter() - tic)))
+
+        def respond_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
+
+
+def start(folder, models, reference_datetime, horizons, host='127.0.0.1', port=0, latency_s=0.0, bandwidth=None,
+          members=0):
+    """Serve the runs of models in folder from a background thread and return the server."""
+    catalogs = [Catalog(folder, model, reference_datetime, horizons, members) for model in models]
+    server = ThreadingHTTPServer((host, port), make_handler(catalogs, latency_s, bandwidth))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_reference_datetime():
+    # Runs start every 3 hours, and 'latest' searches only look back 48 hours
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return now.replace(hour=now.hour // 3 * 3, minute=0, second=0, microsecond=0) - datetime.timedelta(hours=3)
+
+
+def add_arguments(parser):
+    parser.add_argument('--models', nargs='+', default=['ch1'], choices=list(synthetic.cells))
+    parser.add_argument('--grid', choices=list(synthetic.cells), help='size of the synthetic grids, by default the one of each model')
+    parser.add_argument('--horizons', type=int, default=4, help='number of horizons of the run')
+    parser.add_argument('--levels', type=int, default=20, help='number of model levels')
+    parser.add_argument('--members', type=int, default=0, help='number of perturbed ensemble members')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='added to every request')
+    parser.add_argument('--bandwidth', type=float, help='download bandwidth in MB/s, unlimited by default')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8002)
+    args = parser.parse_args()
+
+    reference_datetime = get_reference_datetime()
+    horizons = [datetime.timedelta(hours=h) for h in range(args.horizons)]
+    with tempfile.TemporaryDirectory() as folder:
+        for model in args.models:
+            print(f'Generate {model} run {reference_datetime} with {args.horizons} horizons in {folder}...')
+            generate(folder, model, synthetic.Grid(args.grid or model), reference_datetime, horizons,
+                     list(range(1, args.levels + 1)), args.members)
+        bandwidth = args.bandwidth * 1e6 if args.bandwidth else None
+        server = start(folder, args.models, reference_datetime, horizons, args.host, args.port, args.latency_ms / 1e3,
+                       bandwidth, args.members)
+        print(f'Serving on http://{args.host}:{args.port}, set ogd_api.API_URL to this address')
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
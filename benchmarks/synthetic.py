@@ -0,0 +1,196 @@
+"""Synthetic ICON-like grids, fields and GRIB2 files for the benchmarks.
+
+The grids are jittered lattices over the ICON-CH domain with the cell counts of the
+operational CH1 and CH2 grids, the fields are smooth wind-like patterns plus noise.
+Everything is generated locally, nothing is requested from the OGD API.
+"""
+
+import os
+import sys
+import tempfile
+import uuid
+
+import eccodes
+import numpy as np
+import xarray as xr
+from meteodatalab import data_source, grib_decoder
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import extract
+
+# Number of cells of the operational grids
+cells = {
+    'ch1': 1147980,
+    'ch2': 283876,
+}
+
+# Extent of the ICON-CH domains in degrees
+lon_min, lon_max = -0.8, 17.5
+lat_min, lat_max = 42.1, 50.0
+
+# Rotated lat-lon grids of the former COSMO-1E and COSMO-2E, for regrid.regrid
+rotated_grids = {
+    'ch1': dict(Ni=1170, Nj=786, increment=0.01),
+    'ch2': dict(Ni=582, Nj=390, increment=0.02),
+}
+rotated_first_point = (-8.0, -3.8)
+rotated_south_pole = (10.0, -43.0)
+
+
+class Grid:
+    def __init__(self, model, seed=0):
+        self.model = model
+        # Distinct per model, the remap weights and coordinates are cached by grid UUID
+        self.uuid = uuid.uuid5(uuid.NAMESPACE_OID, f'{model}-{seed}')
+        rng = np.random.default_rng(seed)
+
+        # Jittered lattice with the requested number of cells, close to the
+        # quasi-uniform spacing of the ICON triangles
+        ncells = cells[model]
+        aspect = (lon_max - lon_min) / (lat_max - lat_min)
+        nx = int(np.ceil(np.sqrt(ncells * aspect)))
+        ny = int(np.ceil(ncells / nx))
+        dx = (lon_max - lon_min) / nx
+        dy = (lat_max - lat_min) / ny
+        j, i = np.divmod(np.arange(ncells), nx)
+        self.lon = lon_min + (i + 0.5 + rng.uniform(-0.3, 0.3, ncells)) * dx
+        self.lat = lat_min + (j + 0.5 + rng.uniform(-0.3, 0.3, ncells)) * dy
+
+    @property
+    def ncells(self):
+        return len(self.lon)
+
+    def geo_coords(self, uuid):
+        return {
+            'lat': xr.DataArray(self.lat, dims=('cell',)),
+            'lon': xr.DataArray(self.lon, dims=('cell',)),
+        }
+
+    def values(self, levels, phase=0.0, seed=0):
+        rng = np.random.default_rng(seed)
+        k = np.asarray(levels, dtype=float)[:, None]
+        pattern = 10 * np.sin(np.radians(self.lon) * 40 + phase + k / 10) * np.cos(np.radians(self.lat) * 30)
+        return (pattern + rng.normal(0, 1, pattern.shape)).astype(np.float32)
+
+
+def write_grib(f, grid, variable, values, levels, reference_datetime=None, step=0, type_of_level='generalVerticalLayer',
+               bits_per_value=16, member=None):
+    """Append one GRIB2 message per level to the open file f.
+
+    With a member number, the messages are written as part of an ensemble.
+    """
+    with data_source.cosmo_grib_defs():
+        for level, level_values in zip(levels, values):
+            h = eccodes.codes_grib_new_from_samples('GRIB2')
+            try:
+                eccodes.codes_set(h, 'centre', 'lssw')
+                eccodes.codes_set(h, 'gridDefinitionTemplateNumber', 101)
+                eccodes.codes_set(h, 'numberOfGridUsed', 1)
+                eccodes.codes_set(h, 'numberOfGridInReference', 1)
+                eccodes.codes_set_string(h, 'uuidOfHGrid', grid.uuid.hex)
+                if reference_datetime is not None:
+                    eccodes.codes_set(h, 'dataDate', int(reference_datetime.strftime('%Y%m%d')))
+                    eccodes.codes_set(h, 'dataTime', int(reference_datetime.strftime('%H%M')))
+                eccodes.codes_set_string(h, 'shortName', variable)
+                # The parameter concept resets the level type
+                eccodes.codes_set_string(h, 'typeOfLevel', type_of_level)
+                if type_of_level != 'surface':
+                    eccodes.codes_set(h, 'level', level)
+                if member is not None:
+                    eccodes.codes_set(h, 'productDefinitionTemplateNumber', 1)
+                    eccodes.codes_set(h, 'typeOfEnsembleForecast', 192)
+                    eccodes.codes_set(h, 'perturbationNumber', member)
+                eccodes.codes_set(h, 'stepRange', str(step))
+                eccodes.codes_set(h, 'bitsPerValue', bits_per_value)
+                eccodes.codes_set_values(h, np.asarray(level_values, dtype=float))
+                f.write(eccodes.codes_get_message(h))
+            finally:
+                eccodes.codes_release(h)
+
+
+def write_rotated_grib(f, model, variable, values, levels):
+    """Append one GRIB2 message per level on the rotated lat-lon grid of model."""
+    params = rotated_grids[model]
+    lon, lat = rotated_first_point
+    pole_lon, pole_lat = rotated_south_pole
+    with data_source.cosmo_grib_defs():
+        for level, level_values in zip(levels, values):
+            h = eccodes.codes_grib_new_from_samples('GRIB2')
+            try:
+                eccodes.codes_set(h, 'centre', 'lssw')
+                eccodes.codes_set(h, 'gridDefinitionTemplateNumber', 1)
+                for key, value in {
+                    'Ni': params['Ni'],
+                    'Nj': params['Nj'],
+                    'longitudeOfFirstGridPointInDegrees': lon % 360,
+                    'latitudeOfFirstGridPointInDegrees': lat,
+                    'longitudeOfLastGridPointInDegrees': (lon + (params['Ni'] - 1) * params['increment']) % 360,
+                    'latitudeOfLastGridPointInDegrees': lat + (params['Nj'] - 1) * params['increment'],
+                    'iDirectionIncrementInDegrees': params['increment'],
+                    'jDirectionIncrementInDegrees': params['increment'],
+                    'longitudeOfSouthernPoleInDegrees': pole_lon,
+                    'latitudeOfSouthernPoleInDegrees': pole_lat,
+                    'jScansPositively': 1,
+                }.items():
+                    eccodes.codes_set(h, key, value)
+                eccodes.codes_set_string(h, 'shortName', variable)
+                eccodes.codes_set_string(h, 'typeOfLevel', 'generalVerticalLayer')
+                eccodes.codes_set(h, 'level', level)
+                eccodes.codes_set(h, 'bitsPerValue', 16)
+                eccodes.codes_set_values(h, np.asarray(level_values, dtype=float).ravel())
+                f.write(eccodes.codes_get_message(h))
+            finally:
+                eccodes.codes_release(h)
+
+
+def make_field(grid, variable, levels, seed=0):
+    """Build a (z, cell) field with the attributes of a decoded GRIB2 message.
+
+    Only a single level is encoded and decoded, the values of all levels are then
+    generated directly in memory.
+    """
+    values = grid.values(levels, seed=seed)
+    with tempfile.TemporaryDirectory() as folder:
+        filename = f'{folder}/{variable}.grib2'
+        with open(filename, 'wb') as f:
+            write_grib(f, grid, variable, values[:1], levels[:1])
+        template = grib_decoder.load(
+            source=data_source.FileDataSource(datafiles=[filename]),
+            request={"param": variable, "levelist": levels[:1]},
+            geo_coords=grid.geo_coords,
+        )[variable]
+
+    return xr.DataArray(
+        values,
+        dims=('z', 'cell'),
+        coords={'z': list(levels), 'lon': ('cell', grid.lon), 'lat': ('cell', grid.lat)},
+        attrs=template.attrs,
+    )
+
+
+def make_rotated_field(model, variable, levels, seed=0):
+    """Build a (z, y, x) field on the rotated lat-lon grid of model."""
+    params = rotated_grids[model]
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:params['Nj'], 0:params['Ni']]
+    k = np.asarray(levels, dtype=float)[:, None, None]
+    values = (10 * np.sin(x / 40 + k / 10) * np.cos(y / 30) + rng.normal(0, 1, (len(levels),) + x.shape)).astype(np.float32)
+
+    with tempfile.TemporaryDirectory() as folder:
+        filename = f'{folder}/{variable}.grib2'
+        with open(filename, 'wb') as f:
+            write_rotated_grib(f, model, variable, values[:1], levels[:1])
+        template = grib_decoder.load(
+            source=data_source.FileDataSource(datafiles=[filename]),
+            request={"param": variable, "levelist": levels[:1]},
+        )[variable]
+
+    return xr.DataArray(values, dims=('z', 'y', 'x'), coords={'z': list(levels)}, attrs=template.attrs)
+
+
+def get_destination(scale=1.0):
+    """Destination grid of extract.py with the resolution multiplied by scale."""
+    destination = extract.get_destination()
+    destination.nx = int(round(destination.nx * scale))
+    destination.ny = int(round(destination.ny * scale))
+    return destination
@@ -1,6 +1,7 @@
 from datetime import datetime, timedelta, timezone
 from meteodatalab import ogd_api
 import regrid
+import frame_codecs
 from meteodatalab import grib_decoder, data_source
 from meteodatalab.operators.destagger import destagger
 
@@ -9,33 +10,324 @@ import rasterio
 from rasterio.crs import CRS
 from rasterio.enums import ColorInterp
 import numpy as np
+import xarray as xr
 import json
 import os
+import hashlib
+import zlib
 import shutil
 import requests
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import threading
+import queue
+import collections
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
 successful_api_calls = 0
 failed_api_calls = 0
+api_calls_lock = threading.Lock()
+
+# Models processed by the main loop, in order of priority. Every model has its own
+# pipeline and run tracking, the tasks of all models share one process pool in
+# which the first model is served first and the others use the capacity left over.
+models = ['ch1', 'ch2']
 
+# Downloads, outputs and publishes are kept in one folder per model below these
 cache_path = 'sma-cache'
 data_path = 'data'
 data_copy_path = '/var/www/html/data-copy/'
+# Every publish goes into its own directory below publish_path/{model},
+# data_copy_path/{model} is a symlink to the live one
+publish_path = '/var/www/html/runs'
+publish_keep = 2
+remap_weights_path = 'remap-weights'
+# Height fields per fingerprint of the vertical constants and destination grid
+height_fields_path = 'height-fields'
+# Cell coordinates per grid UUID
+geo_coords_path = 'geo-coords'
+
+discovery_workers = 16
+
+download_workers = 8
+download_retries = 5
+download_backoff_s = 2
+download_chunk_size = 1 << 20
+
+# Horizons downloaded but not yet handed to the process pool, and horizons
+# handed to the process pool per worker, before the pipeline blocks
+pipeline_queue_size = 8
+pipeline_tasks_per_worker = 2
+
+# Horizons are split into tasks of this many levels, so that the pool stays busy
+# until the end of a run
+levels_per_task = 20
+# Memory estimate of one task, used to size the process pool
+task_base_memory = 512 * 2**20
+task_level_memory = 40 * 2**20
+max_workers = None
 
 z_values = range(1, 81)
 
+# Number of points of the destination grid, the extent is fixed to Switzerland
+destination_nx = 429
+destination_ny = 195
+
+# Upper bound for the temporary arrays of one remap or weight computation, larger
+# destination grids are processed in chunks of points
+remap_memory_budget = 256 * 2**20
+# Approximate temporary bytes per destination point, for the weights and per
+# remapped level
+weights_bytes_per_point = 512
+remap_bytes_per_point = 64
+
+# 'zlib' encodes the wind PNGs in memory with frame_codecs.encode_png, 'rasterio'
+# goes through the GDAL PNG driver
+png_encoder = 'zlib'
+png_compression_level = 6
+png_compression_strategy = zlib.Z_RLE
+# PNG scanline filter: 0 none, 1 sub, 2 up
+png_filter = 2
+# Write all levels of a horizon into one atlas PNG with a JSON index of the tile
+# offsets, instead of one PNG per level
+png_atlas = False
+# Codec of the wind frames, see frame_codecs.py. 'png' frames are written with
+# png_encoder, the other codecs change the extension of the frame files. Atlases
+# and tiles are always PNG.
+frame_codec = 'png'
+
+# Also write a Web Mercator XYZ tile pyramid of every wind frame below
+# {data_path}/{model}/tiles/{frame}/{zoom}/{x}/{y}.png
+xyz_tiles = False
+xyz_min_zoom = 5
+xyz_max_zoom = 9
+xyz_tile_size = 256
+web_mercator_half_size = 20037508.342789244
+
+# Also write U, V and the height fields into a (time, z, y, x) Zarr store per run.
+# Each horizon is one shard, so workers never write to the same file, and the
+# inner chunks keep map frames and single columns cheap to read.
+zarr_output = False
+zarr_chunks = (1, 16, 64, 64)
+
+# Also write wind frames interpolated to fixed altitudes above mean sea level
+# ({h}M) and above ground level ({h}AGL), next to the model level frames
+altitude_output = False
+altitudes_amsl = list(range(600, 3001, 200))
+altitudes_agl = [50, 100, 200, 300, 500, 750, 1000]
+
+# Also write U, V and the height fields as memory-mappable (time, z, y, x) .npy
+# files below cube_path, for the point queries of meteogram.py
+cube_output = False
+cube_path = 'cube'
+
+# Publish every horizon as soon as it is available on the OGD API instead of
+# waiting for the whole run to complete
+incremental = False
+
+# Process the whole ensemble: the control run and the perturbed members of every
+# horizon are decoded into one (eps, z, cell) stack and remapped in a single pass
+# with shared weights. Next to the control frames, the ensemble mean wind is
+# written as frames and the spread and the probabilities of exceeding the wind
+# speed thresholds (m/s) as GeoTIFFs. The optional outputs above are only written
+# without ensemble mode.
+ensemble_output = False
+# Members including the control run, used to estimate the memory of a task
+ensemble_members = {'ch1': 11, 'ch2': 21}
+wind_speed_thresholds = [5, 10, 15, 20]
+
+# Timings per stage and per pool worker of the last run, written below metrics_path
+# as a Prometheus textfile (for the textfile collector of the node exporter) and
+# appended as JSON lines
+metrics_path = 'metrics'
+metrics_prometheus = True
+metrics_jsonl = True
+
+metrics_lock = threading.Lock()
+# Per model: timings per stage, per pool worker and totals of the last run
+model_metrics = {}
+
+def get_tmp_filename(filename):
+    # Unique per process and thread, so that concurrent writers of the same file
+    # never write into each other's temporary file
+    return f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+def replace_atomically(filename, write, mode='wb'):
+    # write(f) fills a temporary file that then replaces filename, readers never
+    # see a partially written file and hardlinks to the old file are left intact
+    tmp_filename = get_tmp_filename(filename)
+    try:
+        with open(tmp_filename, mode) as f:
+            write(f)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+def swap_symlink(target, link):
+    # Readers of link see either the old or the new target
+    tmp_link = get_tmp_filename(link)
+    os.symlink(target, tmp_link)
+    os.replace(tmp_link, link)
+
+def get_metrics(model):
+    return model_metrics.setdefault(model, {'stages': {}, 'workers': {}, 'run': {}})
+
+def record_stage(stages, stage, seconds):
+    metric = stages.setdefault(stage, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+    metric['calls'] += 1
+    metric['seconds'] += seconds
+    metric['max_seconds'] = max(metric['max_seconds'], seconds)
+
+@contextmanager
+def timed(stage, stages=None, model=None):
+    # Without stages, the time is added to the run metrics of model in this process
+    tic = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - tic
+        if stages is None:
+            with metrics_lock:
+                record_stage(get_metrics(model)['stages'], stage, seconds)
+        else:
+            record_stage(stages, stage, seconds)
+
+def record_task(model, task):
+    # Timings returned by make_horizon from a pool worker
+    with metrics_lock:
+        metrics = get_metrics(model)
+        for stage, metric in task['stages'].items():
+            total = metrics['stages'].setdefault(stage, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            total['calls'] += metric['calls']
+            total['seconds'] += metric['seconds']
+            total['max_seconds'] = max(total['max_seconds'], metric['max_seconds'])
+        worker = metrics['workers'].setdefault(task['pid'], {'tasks': 0, 'busy_seconds': 0.0})
+        worker['tasks'] += 1
+        worker['busy_seconds'] += task['seconds']
+        metrics['run']['frames'] = metrics['run'].get('frames', 0) + task['frames']
+
+def add_run_metric(model, name, value):
+    with metrics_lock:
+        run_metrics = get_metrics(model)['run']
+        run_metrics[name] = run_metrics.get(name, 0) + value
+
+def reset_metrics(model):
+    with metrics_lock:
+        model_metrics.pop(model, None)
+
+def write_prometheus(filename, model, time_to_publish):
+    labels = f'model="{model}"'
+    lines = []
+    metrics = get_metrics(model)
+    stage_metrics = metrics['stages']
+    run_metrics = metrics['run']
+
+    def metric(name, kind, description, samples):
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for sample_labels, value in samples:
+            lines.append(f'{name}{{{",".join([labels] + sample_labels)}}} {value}')
+
+    metric('extract_stage_seconds', 'gauge', 'Time spent per stage in the last run, summed over threads and workers.',
+           [([f'stage="{stage}"'], m['seconds']) for stage, m in stage_metrics.items()])
+    metric('extract_stage_max_seconds', 'gauge', 'Longest single call per stage in the last run.',
+           [([f'stage="{stage}"'], m['max_seconds']) for stage, m in stage_metrics.items()])
+    metric('extract_stage_calls', 'gauge', 'Calls per stage in the last run.',
+           [([f'stage="{stage}"'], m['calls']) for stage, m in stage_metrics.items()])
+    workers = sorted(metrics['workers'].items())
+    metric('extract_worker_busy_seconds', 'gauge', 'Time spent in tasks per pool worker in the last run.',
+           [([f'worker="{i}"'], w['busy_seconds']) for i, (_, w) in enumerate(workers)])
+    metric('extract_worker_tasks', 'gauge', 'Tasks per pool worker in the last run.',
+           [([f'worker="{i}"'], w['tasks']) for i, (_, w) in enumerate(workers)])
+    metric('extract_time_to_publish_seconds', 'gauge', 'Time from the start of the last run to its publish.',
+           [([], time_to_publish)])
+    metric('extract_frames', 'gauge', 'Frames written in the last run.', [([], run_metrics.get('frames', 0))])
+    metric('extract_frames_per_second', 'gauge', 'Frames written per second of pipeline in the last run.',
+           [([], run_metrics.get('frames_per_second', 0))])
+    metric('extract_download_bytes', 'gauge', 'Bytes downloaded in the last run.',
+           [([], run_metrics.get('download_bytes', 0))])
+    metric('extract_api_calls_total', 'counter', 'Calls to the OGD API since the start of the process.',
+           [(['result="success"'], successful_api_calls), (['result="failure"'], failed_api_calls)])
+    metric('extract_last_publish_timestamp_seconds', 'gauge', 'Time of the last publish.', [([], time.time())])
+
+    # The collector must never read a partial file
+    replace_atomically(filename, lambda f: f.write('\n'.join(lines) + '\n'), mode='w')
+
+def write_metrics(model, reference_datetime, time_to_publish):
+    os.makedirs(metrics_path, exist_ok=True)
+    with metrics_lock:
+        metrics = get_metrics(model)
+        run_metrics = metrics['run']
+        if run_metrics.get('pipeline_seconds'):
+            run_metrics['frames_per_second'] = run_metrics.get('frames', 0) / run_metrics['pipeline_seconds']
+
+        if metrics_prometheus:
+            # One file per model, the textfile collector merges them
+            write_prometheus(f'{metrics_path}/extract-{model}.prom', model, time_to_publish)
+
+        if metrics_jsonl:
+            with open(f'{metrics_path}/extract.jsonl', 'a') as f:
+                f.write(json.dumps({
+                    'timestamp': time.time(),
+                    'model': model,
+                    'reference_datetime': reference_datetime.isoformat(),
+                    'time_to_publish_seconds': time_to_publish,
+                    **run_metrics,
+                    'stages': metrics['stages'],
+                    'workers': {str(pid): worker for pid, worker in metrics['workers'].items()},
+                    'api_calls': {'success': successful_api_calls, 'failure': failed_api_calls},
+                }) + '\n')
+
+        print(f'{model}: ' + ', '.join(f'{stage} {m["seconds"]:.1f} s' for stage, m in metrics['stages'].items()))
+
 def get_collection(model):
     return f'ogd-forecasting-icon-{model}'
 
+def get_cache_folder(model):
+    return f'{cache_path}/{model}'
+
+def get_data_folder(model):
+    return f'{data_path}/{model}'
+
+def get_constants_filename(model, prefix):
+    # Downloaded by ogd_api.download_from_ogd next to the first asset of a run
+    return f'{get_cache_folder(model)}/{prefix}_constants_icon-{model}-eps.grib2'
+
 def get_horizons(model):
     #                                            34
     return [timedelta(hours=h) for h in range(0, 34 if model == 'ch1' else 121)]
 
-def get_latest_reference_datetime(model, variable, perturbed, horizon):
+def get_asset_urls(request):
+    # Every STAC search goes through here, so that it is counted in the API calls
     global successful_api_calls
     global failed_api_calls
-    
+
+    try:
+        urls = ogd_api.get_asset_urls(request)
+    except requests.exceptions.RequestException:
+        with api_calls_lock:
+            failed_api_calls += 1
+        raise
+    with api_calls_lock:
+        successful_api_calls += 1
+    return urls
+
+def get_assets(perturbed):
+    # Assets of a horizon as (variable, perturbed), the ensemble mode needs the
+    # perturbed members as well. A horizon is only available, and a run only
+    # complete, once all of them are in the catalog.
+    if ensemble_output:
+        return [(variable, asset_perturbed) for variable in ['U', 'V'] for asset_perturbed in [False, True]]
+    return [(variable, perturbed) for variable in ['U', 'V']]
+
+def get_latest_reference_datetime(model, variable, perturbed, horizon):
     r = ogd_api.Request(
         collection=get_collection(model),
         variable=variable,
@@ -44,109 +336,190 @@ def get_latest_reference_datetime(model, variable, perturbed, horizon):
         horizon=horizon,
     )
     try:
-        urls = ogd_api.get_asset_urls(r)
+        urls = get_asset_urls(r)
     except (requests.exceptions.JSONDecodeError, requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as e:
-        failed_api_calls += 1
         return None
-    successful_api_calls += 1
     if len(urls) < 1:
         return None
     parts = urls[0].split('-')
     return datetime.strptime(parts[3], '%Y%m%d%H%M').replace(tzinfo=timezone.utc)
 
-def get_latest_completed_reference_datetime(model):
-    reference_datetimes = []
+# Last discovery result per model: the latest reference datetimes of U and V at
+# the last horizon, and the latest completed reference datetime derived from them
+discovery_state = {}
+
+def get_latest_completed_reference_datetime(model, perturbed):
     horizons = get_horizons(model)
-    for variable in ['U', 'V']:
-        for perturbed in [False]:
-            for horizon in horizons:
-                print('Checking for latest data: variable', variable, 'perturbed', perturbed, 'horizon', horizon)
-                reference_datetime = get_latest_reference_datetime(model, variable, perturbed, horizon)
-                print(reference_datetime)
-                if reference_datetime is not None:
-                    reference_datetimes.append(reference_datetime)
+    assets = get_assets(perturbed)
+
+    def probe(variable, perturbed, horizon):
+        reference_datetime = get_latest_reference_datetime(model, variable, perturbed, horizon)
+        print('Checking for latest data: variable', variable, 'perturbed', perturbed, 'horizon', horizon, reference_datetime)
+        return reference_datetime
+
+    with ThreadPoolExecutor(max_workers=discovery_workers) as executor:
+        # The last horizon of a run is published last, so as long as it did not
+        # change the catalog holds no new completed run
+        last = list(executor.map(lambda asset: probe(*asset, horizons[-1]), assets))
+        if None not in last and model in discovery_state and discovery_state[model][0] == last:
+            print('Catalog unchanged since last discovery')
+            return discovery_state[model][1]
+
+        probes = [
+            (variable, asset_perturbed, horizon)
+            for variable, asset_perturbed in assets
+            for horizon in horizons[:-1]
+        ]
+        reference_datetimes = last + list(executor.map(probe, *zip(*probes)))
+
+    reference_datetimes = [r for r in reference_datetimes if r is not None]
+    latest_completed = min(reference_datetimes)
+    # Only a consistent catalog is remembered. While earlier horizons still lag
+    # behind the last one, the next discovery must probe all horizons again.
+    if None not in last and latest_completed == max(last):
+        discovery_state[model] = (last, latest_completed)
+    return latest_completed
+
+def get_latest_started_reference_datetime(model):
+    horizon = get_horizons(model)[0]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        reference_datetimes = list(executor.map(
+            lambda variable: get_latest_reference_datetime(model, variable, False, horizon), ['U', 'V']
+        ))
+    if None in reference_datetimes:
+        return None
     return min(reference_datetimes)
 
+def get_available_horizons(model, reference_datetime, perturbed, horizons):
+    assets = get_assets(perturbed)
+    probes = [(variable, asset_perturbed, horizon) for horizon in horizons for variable, asset_perturbed in assets]
+    with ThreadPoolExecutor(max_workers=discovery_workers) as executor:
+        latest = list(executor.map(lambda probe: get_latest_reference_datetime(model, *probe), probes))
+    available = {probe: r == reference_datetime for probe, r in zip(probes, latest)}
+    return [horizon for horizon in horizons if all(available[(*asset, horizon)] for asset in assets)]
+
 def save_png(f_U, f_V, filename):
-    shift = 128
-    ms_to_kmh = 3.6
-    nan_value = 0
-
-    alpha = np.ones(f_U.values.shape)
-    alpha[np.isnan(f_U.values)] = 0
-    alpha *= 255
-
-    f_U_vals = f_U.values.copy()
-    f_V_vals = f_V.values.copy()
-
-    f_U_vals[np.isfinite(f_U_vals)] *= ms_to_kmh
-    f_U_vals[np.isfinite(f_U_vals)] += shift
-    f_U_vals[np.isnan(f_U_vals)] = nan_value
-
-    f_V_vals[np.isfinite(f_V_vals)] *= ms_to_kmh
-    f_V_vals[np.isfinite(f_V_vals)] += shift
-    f_V_vals[np.isnan(f_V_vals)] = nan_value
-
-    rgba = np.stack(
-        [
-            f_U_vals.astype(np.uint8),
-            f_V_vals.astype(np.uint8),
-            np.zeros(f_U_vals.shape).astype(np.uint8),
-            alpha.astype(np.uint8)
-        ], 
-        axis=0
-    )
+    rgba_flipped = frame_codecs.get_rgba(f_U.values, f_V.values)
+
+    def write(f):
+        with rasterio.open(
+            f,
+            "w",
+            driver="PNG",
+            height=f_U.shape[0],
+            width=f_U.shape[1],
+            count=4,
+            dtype=rgba_flipped.dtype,
+        ) as dst:
+            dst.write(rgba_flipped)
+            dst.colorinterp = [ColorInterp.red, ColorInterp.green, ColorInterp.blue, ColorInterp.alpha]
+
+    # Frames are published while the other horizons are still being written
+    replace_atomically(filename, write)
+
+def save_png_zlib(f_U, f_V, filename):
+    data = frame_codecs.encode_png(f_U, f_V, png_compression_level, png_compression_strategy, png_filter)
+    replace_atomically(filename, lambda f: f.write(data))
 
-    rgba_flipped = rgba[:, ::-1, :]
+def save_frame_codec(f_U, f_V, filename):
+    data = frame_codecs.encode(frame_codec, f_U, f_V)
+    replace_atomically(filename, lambda f: f.write(data))
 
-    with rasterio.open(
-        filename,
-        "w",
-        driver="PNG",
-        height=f_U.shape[0],
-        width=f_U.shape[1],
-        count=4,
-        dtype=rgba.dtype,
-    ) as dst:
-        dst.write(rgba_flipped)
-        dst.colorinterp = [ColorInterp.red, ColorInterp.green, ColorInterp.blue, ColorInterp.alpha]
+def get_save_frame():
+    if frame_codec != 'png':
+        return save_frame_codec
+    return save_png_zlib if png_encoder == 'zlib' else save_png
 
 def save_geotiff(da, filename):
     print(f'Writing {filename}...')
-    with rasterio.open(
-        filename,
-        "w",
-        driver="GTiff",
-        height=da.shape[0],
-        width=da.shape[1],
-        count=1,
-        dtype=np.float32,
-        crs=da.crs if hasattr(da, 'crs') else None,
-        transform=da.rio.transform() if hasattr(da, 'rio') else None,
-    ) as dst:
-        dst.write(da.values[::-1, :].astype(np.float32), 1)
-
-def get_delauny(da):
+
+    def write(f):
+        with rasterio.open(
+            f,
+            "w",
+            driver="GTiff",
+            height=da.shape[0],
+            width=da.shape[1],
+            count=1,
+            dtype=np.float32,
+            crs=da.crs if hasattr(da, 'crs') else None,
+            transform=da.rio.transform() if hasattr(da, 'rio') else None,
+        ) as dst:
+            dst.write(da.values[::-1, :].astype(np.float32), 1)
+
+    replace_atomically(filename, write)
+
+def get_destination():
     xmin = 5.379264
     xmax = 11.024297
     ymin = 45.497280
     ymax = 48.105836
 
-    nx = 429
-    ny = 195
+    nx = destination_nx
+    ny = destination_ny
 
-    destination = regrid.RegularGrid(
+    return regrid.RegularGrid(
         CRS.from_string("epsg:4326"), nx, ny, xmin, xmax, ymin, ymax
     )
-    return (destination,) + regrid.iconremap_delauny(da, destination)
 
-def reproject_with_delauny(da, destination, indices, weights, lon, lat):
-    return regrid.icon2regular(da, destination, indices, weights).assign_coords(
+def get_remap_weights_filename(uuid, destination):
+    key = '-'.join(str(v) for v in [
+        uuid,
+        destination.crs.to_string(),
+        destination.nx,
+        destination.ny,
+        destination.xmin,
+        destination.xmax,
+        destination.ymin,
+        destination.ymax,
+    ])
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return f'{remap_weights_path}/delauny-{digest}.npz'
+
+# Remap weights and sparse operators already loaded in this process, keyed by
+# cache filename
+remap_weights = {}
+remap_operators = {}
+
+def get_delauny(da, destination=None):
+    if destination is None:
+        destination = get_destination()
+    uuid = da.metadata.get('uuidOfHGrid')
+    filename = get_remap_weights_filename(uuid, destination)
+
+    if filename not in remap_weights:
+        try:
+            with np.load(filename) as f:
+                remap_weights[filename] = (f['indices'], f['weights'], f['lon'], f['lat'])
+        except (FileNotFoundError, ValueError, KeyError):
+            print(f'Compute remap weights {filename}...')
+            indices, weights, lon, lat = regrid.iconremap_delauny(
+                da, destination, chunk_size=remap_memory_budget // weights_bytes_per_point
+            )
+            os.makedirs(remap_weights_path, exist_ok=True)
+            # The grid UUID lets users of the file outside of this cache, such as the
+            # Lambda handler, check that it matches their data
+            replace_atomically(
+                filename, lambda f: np.savez(f, indices=indices, weights=weights, lon=lon, lat=lat, uuid=str(uuid))
+            )
+            remap_weights[filename] = (indices, weights, lon, lat)
+
+    indices, weights, lon, lat = remap_weights[filename]
+    if filename not in remap_operators:
+        remap_operators[filename] = regrid.remap_operator(indices, weights, da.sizes['cell'])
+
+    return destination, indices, weights, lon, lat, remap_operators[filename]
+
+def reproject_with_delauny(da, destination, indices, weights, lon, lat, operator=None):
+    levels = da.size // da.sizes['cell']
+    chunk_size = remap_memory_budget // (remap_bytes_per_point * levels)
+    return regrid.icon2regular(da, destination, indices, weights, operator, chunk_size).assign_coords(
         lon=(("y", "x"), lon), lat=(("y", "x"), lat)
     ).squeeze()
 
 def get_filename(model, variable, reference_datetime, perturbed, horizon):
-    return f'icon-{model}-eps-{get_timestring(reference_datetime)}-{get_horizon_hours(horizon)}-{variable.lower()}-{"ctrl" if not perturbed else eps}.grib2'
+    # All perturbed members of a horizon are in a single asset
+    return f'icon-{model}-eps-{get_timestring(reference_datetime)}-{get_horizon_hours(horizon)}-{variable.lower()}-{"perturb" if perturbed else "ctrl"}.grib2'
 
 def download(model, variable, reference_datetime, perturbed, horizon):
     print(f'Download {get_filename(model, variable, reference_datetime, perturbed, horizon)}...')
@@ -157,15 +530,126 @@ def download(model, variable, reference_datetime, perturbed, horizon):
         perturbed=perturbed,
         horizon=horizon,
     )
-    ogd_api.download_from_ogd(req, Path(cache_path))
+    ogd_api.download_from_ogd(req, Path(get_cache_folder(model)))
 
-def geo_coords(uuid):
-    ds = grib_decoder.load(
-        source=data_source.FileDataSource(datafiles=[f"{cache_path}/horizontal_constants_icon-ch1-eps.grib2"]), 
-        request={"param": ["CLON", "CLAT"]}, 
-        geo_coords=lambda uuid: {}
+# One persistent HTTP session per download thread
+session_local = threading.local()
+
+def get_session():
+    if not hasattr(session_local, 'session'):
+        session_local.session = requests.Session()
+    return session_local.session
+
+def get_file_hash(filename):
+    hasher = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while chunk := f.read(download_chunk_size):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def download_file(url, filename):
+    # One attempt, resumes a partial download of an earlier attempt
+    session = get_session()
+    part_filename = f'{filename}.part'
+    r = session.head(url, allow_redirects=True, timeout=30)
+    r.raise_for_status()
+    size = int(r.headers.get('Content-Length', -1))
+    checksum = r.headers.get('X-Amz-Meta-Sha256')
+
+    if os.path.exists(filename) and size in (-1, os.path.getsize(filename)) and \
+            checksum in (None, get_file_hash(filename)):
+        print(f'Skip {filename}, already downloaded.')
+        return
+
+    offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+    if offset >= size >= 0:
+        offset = 0
+    headers = {'Range': f'bytes={offset}-'} if offset > 0 else {}
+
+    with session.get(url, headers=headers, stream=True, timeout=30) as r:
+        r.raise_for_status()
+        # Servers without range support answer with the whole file
+        if r.status_code != 206:
+            offset = 0
+        with open(part_filename, 'ab' if offset > 0 else 'wb') as f:
+            for chunk in r.iter_content(chunk_size=download_chunk_size):
+                f.write(chunk)
+
+    if size >= 0 and os.path.getsize(part_filename) != size:
+        raise IOError(f'Incomplete download of {url}')
+    # Like ogd_api.download_from_ogd, a resumed file could be stale or corrupt,
+    # the next attempt starts over
+    if checksum is not None and get_file_hash(part_filename) != checksum:
+        os.remove(part_filename)
+        raise IOError(f'Checksum verification failed for {url}')
+    os.replace(part_filename, filename)
+
+def download_asset(model, variable, reference_datetime, perturbed, horizon):
+    filename = get_filename(model, variable, reference_datetime, perturbed, horizon)
+    print(f'Download {filename}...')
+    req = ogd_api.Request(
+        collection=get_collection(model),
+        variable=variable,
+        reference_datetime=reference_datetime,
+        perturbed=perturbed,
+        horizon=horizon,
     )
-    return {"lat": ds["CLAT"].squeeze(), "lon": ds["CLON"].squeeze()}
+    for attempt in range(download_retries):
+        try:
+            # The search is retried along with the transfer
+            urls = get_asset_urls(req)
+            if len(urls) != 1:
+                raise ValueError(f'Expected one asset for {filename}, found {len(urls)}')
+            with timed('download', model=model):
+                download_file(urls[0], f'{get_cache_folder(model)}/{filename}')
+            break
+        except (requests.exceptions.RequestException, IOError) as e:
+            backoff = download_backoff_s * 2 ** attempt
+            print(f'Download of {filename} failed ({e}), retry in {backoff} s...')
+            time.sleep(backoff)
+    else:
+        raise RuntimeError(f'Could not download {filename} after {download_retries} attempts')
+    add_run_metric(model, 'download_bytes', os.path.getsize(f'{get_cache_folder(model)}/{filename}'))
+
+def get_geo_coords_filename(uuid, name):
+    # The decoder passes a UUID to geo_coords, the metadata holds the plain hex string
+    return f'{geo_coords_path}/{str(uuid).replace("-", "")}-{name}.npy'
+
+# data_source.cosmo_grib_defs switches the eccodes definitions of the whole
+# process, the pipeline threads of the models decode one at a time
+decode_lock = threading.RLock()
+
+def save_geo_coords(model):
+    with decode_lock:
+        ds = grib_decoder.load(
+            source=data_source.FileDataSource(datafiles=[get_constants_filename(model, 'horizontal')]), 
+            request={"param": ["CLON", "CLAT"]}, 
+            geo_coords=lambda uuid: {}
+        )
+    # Keyed by grid, so that the workers find the coordinates of every model from
+    # the UUID passed to geo_coords
+    uuid = ds['CLON'].metadata.get('uuidOfHGrid')
+    os.makedirs(geo_coords_path, exist_ok=True)
+    for name, param in [('lat', 'CLAT'), ('lon', 'CLON')]:
+        values = ds[param].squeeze().values
+        replace_atomically(get_geo_coords_filename(uuid, name), lambda f: np.save(f, values))
+
+# Coordinates already loaded in this process, keyed by grid UUID. The arrays are
+# decoded once by save_geo_coords and memory-mapped, so all workers share the
+# same pages.
+geo_coords_cache = {}
+
+def geo_coords(uuid):
+    if uuid not in geo_coords_cache:
+        if not os.path.exists(get_geo_coords_filename(uuid, 'lon')):
+            for model in models:
+                if os.path.exists(get_constants_filename(model, 'horizontal')):
+                    save_geo_coords(model)
+        geo_coords_cache[uuid] = {
+            name: xr.DataArray(np.load(get_geo_coords_filename(uuid, name), mmap_mode='r'), dims=('cell',))
+            for name in ['lat', 'lon']
+        }
+    return geo_coords_cache[uuid]
 
 def get_timestring(reference_datetime):
     return reference_datetime.strftime('%Y%m%d%H%M')
@@ -176,7 +660,7 @@ def get_horizon_hours(horizon):
 def read(model, variable, reference_datetime, perturbed, horizon, eps, z):
     filename = get_filename(model, variable, reference_datetime, perturbed, horizon)
     data = grib_decoder.load(
-        source=data_source.FileDataSource(datafiles=[f"{cache_path}/{filename}"]), 
+        source=data_source.FileDataSource(datafiles=[f"{get_cache_folder(model)}/{filename}"]), 
         request={
             "param": variable,
             "levelist": z,
@@ -185,147 +669,940 @@ def read(model, variable, reference_datetime, perturbed, horizon, eps, z):
     )
     return data[variable]
 
-def make_horizon(reference_datetime, horizon, model, perturbed, eps):
-    os.makedirs(data_path, exist_ok=True)
+def read_members(model, variable, reference_datetime, horizon, z):
+    # The control run becomes member 0 of the stack of perturbed members
+    members = []
+    for perturbed in [False, True]:
+        da = read(model, variable, reference_datetime, perturbed, horizon, None, z)
+        if 'eps' not in da.dims:
+            da = da.expand_dims(eps=[0])
+        members.append(da)
+    return xr.concat(members, dim='eps', coords='minimal', compat='override')
 
-    destination_U = None
-    indices_U = None
-    weights_U = None
-    lon_U = None
-    lat_U = None
+def get_member_name(model, perturbed, eps):
+    # {MODEL}-{MEMBER}, the prefix of the frames, atlases, Zarr stores and cubes
+    member_filename = f'EPS{eps}' if perturbed else 'CTRL'
+    return f'{model.upper()}-{member_filename}'
 
-    destination_V = None
-    indices_V = None
-    weights_V = None
-    lon_V = None
-    lat_V = None
+def get_png_filename(reference_datetime, horizon, model, perturbed, eps, z):
+    return get_frame_filename(reference_datetime, horizon, model, perturbed, eps, f'Z{z}')
 
-    for z in z_values:
-        print(f'Working on horizon={get_horizon_hours(horizon)}, z={z}...')
-        da_U = read(model, 'U', reference_datetime, perturbed, horizon, eps, z)
-        da_V = read(model, 'V', reference_datetime, perturbed, horizon, eps, z)
-
-        if destination_U is None:
-            destination_U, indices_U, weights_U, lon_U, lat_U = get_delauny(da_U)
-            destination_V, indices_V, weights_V, lon_V, lat_V = get_delauny(da_V)
-
-        f_U = reproject_with_delauny(da_U, destination_U, indices_U, weights_U, lon_U, lat_U)
-        f_V = reproject_with_delauny(da_V, destination_V, indices_V, weights_V, lon_V, lat_V)
-
-        member_filename = f'EPS{eps}' if perturbed else 'CTRL'
-        model_filename = model.upper()
-        z_filename = f'Z{z}'
-        time_filename = int((reference_datetime + horizon).timestamp())
-        filename = f'{data_path}/{model_filename}-{member_filename}-{z_filename}-{time_filename}-wind.png'
-        save_png(f_U, f_V, filename)
-
-def make_height_fields():
-    ds = grib_decoder.load(
-        source=data_source.FileDataSource(datafiles=[f"{cache_path}/vertical_constants_icon-ch1-eps.grib2"]), 
-        request={"param": "HHL"}, 
-        geo_coords=geo_coords
+def get_frame_filename(reference_datetime, horizon, model, perturbed, eps, level_filename):
+    time_filename = int((reference_datetime + horizon).timestamp())
+    return f'{get_member_name(model, perturbed, eps)}-{level_filename}-{time_filename}-wind.{frame_codecs.get_codec(frame_codec).extension}'
+
+def get_atlas_filename(reference_datetime, horizon, model, perturbed, eps):
+    time_filename = int((reference_datetime + horizon).timestamp())
+    return f'{get_member_name(model, perturbed, eps)}-{time_filename}-wind-atlas'
+
+def save_atlas(f_U, f_V, levels, filename):
+    ny, nx = f_U.sizes['y'], f_U.sizes['x']
+    columns = int(np.ceil(np.sqrt(len(levels))))
+    rows = int(np.ceil(len(levels) / columns))
+
+    # Tiles are placed in image orientation (north up), frame_codecs.encode_png flips rows
+    atlas_U = np.full((rows * ny, columns * nx), np.nan)
+    atlas_V = np.full((rows * ny, columns * nx), np.nan)
+    tiles = {}
+    for i, z in enumerate(levels):
+        row, column = divmod(i, columns)
+        tile = np.s_[row * ny:(row + 1) * ny, column * nx:(column + 1) * nx]
+        atlas_U[tile] = f_U.sel(z=z).values[::-1]
+        atlas_V[tile] = f_V.sel(z=z).values[::-1]
+        tiles[f'Z{z}'] = [column * nx, row * ny]
+
+    data = frame_codecs.encode_png(atlas_U[::-1], atlas_V[::-1], png_compression_level, png_compression_strategy,
+                                   png_filter)
+    replace_atomically(f'{filename}.png', lambda f: f.write(data))
+    replace_atomically(f'{filename}.json', lambda f: json.dump({'width': nx, 'height': ny, 'tiles': tiles}, f), mode='w')
+    return [f'{filename}.png', f'{filename}.json']
+
+def get_tile_grid(x, y, zoom):
+    tile_extent = 2 * web_mercator_half_size / 2 ** zoom
+    resolution = tile_extent / xyz_tile_size
+    # RegularGrid coordinates are pixel centers
+    xmin = -web_mercator_half_size + x * tile_extent + resolution / 2
+    ymax = web_mercator_half_size - y * tile_extent - resolution / 2
+    return regrid.RegularGrid(
+        CRS.from_epsg(3857),
+        xyz_tile_size,
+        xyz_tile_size,
+        xmin,
+        xmin + tile_extent - resolution,
+        ymax - tile_extent + resolution,
+        ymax,
     )
-    hfl = destagger(ds["HHL"].squeeze(drop=True), "z")
-    
-    os.makedirs(data_path, exist_ok=True)
-    
-    destination = None
-    indices = None
-    weights = None
-    lon = None
-    lat = None
+
+def get_tiles(zoom):
+    destination = get_destination()
+    n = 2 ** zoom
+
+    def tile_x(lon):
+        return int(np.floor((lon + 180) / 360 * n))
+
+    def tile_y(lat):
+        return int(np.floor((1 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2 * n))
+
+    return [
+        (x, y)
+        for x in range(tile_x(destination.xmin), tile_x(destination.xmax) + 1)
+        for y in range(tile_y(destination.ymax), tile_y(destination.ymin) + 1)
+    ]
+
+def save_tiles(da_U, da_V, levels, reference_datetime, horizon, model, perturbed, eps):
+    filenames = []
+    for zoom in range(xyz_min_zoom, xyz_max_zoom + 1):
+        for x, y in get_tiles(zoom):
+            # The tile weights go through the same on-disk cache as the main grid
+            destination, indices, weights, lon, lat, operator = get_delauny(da_U, get_tile_grid(x, y, zoom))
+            # Tiles entirely outside of the ICON domain are left out, pixels outside
+            # of it are NaN and transparent in the tiles at its edge
+            if operator.nnz == 0:
+                continue
+            t_U = ensure_z(reproject_with_delauny(da_U, destination, indices, weights, lon, lat, operator))
+            t_V = ensure_z(reproject_with_delauny(da_V, destination, indices, weights, lon, lat, operator))
+
+            for z in levels:
+                frame = get_png_filename(reference_datetime, horizon, model, perturbed, eps, z).removesuffix(
+                    f'.{frame_codecs.get_codec(frame_codec).extension}'
+                )
+                folder = f'{get_data_folder(model)}/tiles/{frame}/{zoom}/{x}'
+                os.makedirs(folder, exist_ok=True)
+                data = frame_codecs.encode_png(t_U.sel(z=z), t_V.sel(z=z), png_compression_level,
+                                               png_compression_strategy, png_filter)
+                replace_atomically(f'{folder}/{y}.png', lambda f: f.write(data))
+                filenames.append(f'{folder}/{y}.png')
+    return filenames
+
+def get_zarr_filename(model, perturbed, eps):
+    return f'{get_member_name(model, perturbed, eps)}-wind.zarr'
+
+def create_zarr_store(reference_datetime, model, perturbed, eps):
+    if zarr is None:
+        raise ImportError('zarr_output requires the zarr package')
+
+    filename = f'{get_data_folder(model)}/{get_zarr_filename(model, perturbed, eps)}'
+    group = zarr.open_group(filename, mode='a')
+    if 'U' in group:
+        return filename
+
+    print(f'Create {filename}...')
+    destination = get_destination()
+    horizons = get_horizons(model)
+    shape = (len(horizons), len(z_values), destination.ny, destination.nx)
+    shards = (1,) + tuple(-(-n // c) * c for n, c in zip(shape[1:], zarr_chunks[1:]))
+    compressors = zarr.codecs.BloscCodec(cname='zstd', clevel=5, shuffle='shuffle')
+
+    for variable in ['U', 'V']:
+        group.create_array(
+            variable,
+            shape=shape,
+            chunks=zarr_chunks,
+            shards=shards,
+            dtype='float32',
+            fill_value=np.nan,
+            compressors=compressors,
+            dimension_names=('time', 'z', 'y', 'x'),
+            attributes={'units': 'm s-1'},
+        )
+    group.create_array(
+        'hfl',
+        shape=shape[1:],
+        chunks=zarr_chunks[1:],
+        shards=shards[1:],
+        dtype='float32',
+        fill_value=np.nan,
+        compressors=compressors,
+        dimension_names=('z', 'y', 'x'),
+        attributes={'units': 'm'},
+    )
+
+    coords = {
+        'time': np.array([int((reference_datetime + horizon).timestamp()) for horizon in horizons]),
+        'z': np.array(z_values),
+        'y': destination.y,
+        'x': destination.x,
+    }
+    for name, values in coords.items():
+        group.create_array(name, data=values, dimension_names=(name,))
+    group['time'].attrs['units'] = 'seconds since 1970-01-01'
+    group.attrs['reference_datetime'] = int(reference_datetime.timestamp())
+    group.attrs['crs'] = destination.crs.to_string()
+    return filename
+
+def save_zarr(f_U, f_V, reference_datetime, horizon, model, perturbed, eps):
+    group = zarr.open_group(f'{get_data_folder(model)}/{get_zarr_filename(model, perturbed, eps)}', mode='r+')
+    t = get_horizons(model).index(horizon)
+    group['U'][t] = f_U.transpose('z', 'y', 'x').values.astype(np.float32)
+    group['V'][t] = f_V.transpose('z', 'y', 'x').values.astype(np.float32)
+
+def get_cube_folder(reference_datetime, model, perturbed, eps):
+    return f'{cube_path}/{get_member_name(model, perturbed, eps)}-{int(reference_datetime.timestamp())}'
+
+def write_cube_index(folder, index):
+    replace_atomically(f'{folder}/index.json', lambda f: json.dump(index, f), mode='w')
+
+def create_cube(reference_datetime, model, perturbed, eps):
+    folder = get_cube_folder(reference_datetime, model, perturbed, eps)
+    if os.path.exists(f'{folder}/index.json'):
+        return folder
+
+    print(f'Create {folder}...')
+    os.makedirs(folder, exist_ok=True)
+    destination = get_destination()
+    horizons = get_horizons(model)
+    shape = (len(horizons), len(z_values), destination.ny, destination.nx)
+    for variable in ['U', 'V']:
+        np.lib.format.open_memmap(f'{folder}/{variable}.npy', mode='w+', dtype=np.float32, shape=shape)
+    np.lib.format.open_memmap(f'{folder}/hfl.npy', mode='w+', dtype=np.float32, shape=shape[1:])
+
+    write_cube_index(folder, {
+        'reference_datetime': int(reference_datetime.timestamp()),
+        'crs': destination.crs.to_string(),
+        'nx': destination.nx,
+        'ny': destination.ny,
+        'xmin': destination.xmin,
+        'xmax': destination.xmax,
+        'ymin': destination.ymin,
+        'ymax': destination.ymax,
+        'z': list(z_values),
+        'time': [int((reference_datetime + horizon).timestamp()) for horizon in horizons],
+        'available': [False] * len(horizons),
+    })
+    return folder
+
+def save_cube(f_U, f_V, reference_datetime, horizon, model, perturbed, eps):
+    folder = get_cube_folder(reference_datetime, model, perturbed, eps)
+    t = get_horizons(model).index(horizon)
+    # A task may hold only part of the levels of a horizon
+    k = [list(z_values).index(z) for z in f_U.z.values]
+    for variable, f in [('U', f_U), ('V', f_V)]:
+        cube = np.load(f'{folder}/{variable}.npy', mmap_mode='r+')
+        cube[t, k] = f.transpose('z', 'y', 'x').values
+        cube.flush()
+
+def publish_cube_horizon(folder, horizon, model, perturbed, eps):
+    with open(f'{folder}/index.json') as f:
+        index = json.load(f)
+    index['available'][get_horizons(model).index(horizon)] = True
+    write_cube_index(folder, index)
+
+    # Point the cube name at the run that was just extended and drop older runs
+    name = get_member_name(model, perturbed, eps)
+    link = f'{cube_path}/{name}'
+    swap_symlink(os.path.basename(folder), link)
+    for other in os.listdir(cube_path):
+        other_folder = f'{cube_path}/{other}'
+        if other.startswith(f'{name}-') and other_folder != folder and not os.path.islink(other_folder):
+            shutil.rmtree(other_folder, ignore_errors=True)
+
+def get_vertical_weights_filename(model):
+    return f'{get_cache_folder(model)}/vertical-weights.npz'
+
+def make_vertical_weights(model, hfl, surface):
+    # hfl has shape (z, npts) and decreases with z, surface has shape (npts,)
+    targets = [(f'{h}M', np.full(surface.shape, h, dtype=float)) for h in altitudes_amsl]
+    targets += [(f'{h}AGL', surface + h) for h in altitudes_agl]
+
+    nz, npts = hfl.shape
+    upper = np.empty((len(targets), npts), dtype=np.int32)
+    weights = np.empty((len(targets), npts), dtype=np.float32)
+    for i, (_, target) in enumerate(targets):
+        # Number of levels above the target height, the target lies between the
+        # lowest of them and the next level below
+        above = np.sum(hfl > target, axis=0)
+        k = np.clip(above - 1, 0, nz - 2)
+        h_upper = np.take_along_axis(hfl, k[None], axis=0)[0]
+        h_lower = np.take_along_axis(hfl, k[None] + 1, axis=0)[0]
+        valid = (above >= 1) & (above <= nz - 1)
+        upper[i] = k
+        weights[i] = np.where(valid, (h_upper - target) / (h_upper - h_lower), np.nan)
+
+    names = np.array([name for name, _ in targets])
+    replace_atomically(
+        get_vertical_weights_filename(model), lambda f: np.savez(f, names=names, upper=upper, weights=weights)
+    )
+
+# Vertical weights loaded in this process, keyed by filename and modification time
+vertical_weights = {}
+
+def get_vertical_weights(model):
+    filename = get_vertical_weights_filename(model)
+    key = (filename, os.stat(filename).st_mtime_ns)
+    if key not in vertical_weights:
+        vertical_weights.clear()
+        with np.load(filename) as f:
+            vertical_weights[key] = ([str(name) for name in f['names']], f['upper'], f['weights'])
+    return vertical_weights[key]
+
+def interpolate_to_altitudes(values, upper, weights):
+    # values has shape (..., z, npts), the result (..., altitude, npts)
+    shape = values.shape[:-2] + upper.shape
+    f_upper = np.take_along_axis(values, np.broadcast_to(upper, shape), axis=-2)
+    f_lower = np.take_along_axis(values, np.broadcast_to(upper + 1, shape), axis=-2)
+    return f_upper + weights * (f_lower - f_upper)
+
+def save_altitudes(f_U, f_V, reference_datetime, horizon, model, perturbed, eps, save_frame):
+    names, upper, weights = get_vertical_weights(model)
+    ny, nx = f_U.sizes['y'], f_U.sizes['x']
+    u = interpolate_to_altitudes(f_U.transpose('z', 'y', 'x').values.reshape(-1, ny * nx), upper, weights)
+    v = interpolate_to_altitudes(f_V.transpose('z', 'y', 'x').values.reshape(-1, ny * nx), upper, weights)
+    filenames = []
+    for name, u_altitude, v_altitude in zip(names, u, v):
+        filename = f'{get_data_folder(model)}/{get_frame_filename(reference_datetime, horizon, model, perturbed, eps, name)}'
+        save_frame(xr.DataArray(u_altitude.reshape(ny, nx)), xr.DataArray(v_altitude.reshape(ny, nx)), filename)
+        filenames.append(filename)
+    return filenames
+
+def ensure_z(da):
+    # A single level is squeezed into a scalar z coordinate by the remap
+    return da if 'z' in da.dims else da.expand_dims('z')
+
+def make_horizon(reference_datetime, horizon, model, perturbed, eps, levels=None):
+    # Runs in a pool worker, the timings of the task are returned to the main
+    # process which aggregates them per stage and per worker. The files written
+    # by the task are returned relative to the data folder, for the incremental
+    # publish of the horizon.
+    stages = {}
+    tic = time.perf_counter()
+    if ensemble_output:
+        frames, filenames = write_ensemble_horizon(reference_datetime, horizon, model, levels, stages)
+    else:
+        frames, filenames = write_horizon(reference_datetime, horizon, model, perturbed, eps, levels, stages)
+    return {
+        'pid': os.getpid(),
+        'seconds': time.perf_counter() - tic,
+        'frames': frames,
+        'stages': stages,
+        'files': [os.path.relpath(filename, get_data_folder(model)) for filename in filenames],
+    }
+
+def write_horizon(reference_datetime, horizon, model, perturbed, eps, levels, stages):
+    folder = get_data_folder(model)
+    os.makedirs(folder, exist_ok=True)
+
+    # Decode all levels in a single pass over each GRIB file, the remap below
+    # then works on the whole (z, cell) stack at once
+    levels = tuple(z_values if levels is None else levels)
+    print(f'Working on horizon={get_horizon_hours(horizon)}, z={levels[0]}..{levels[-1]}...')
+    with timed('decode', stages):
+        da_U = read(model, 'U', reference_datetime, perturbed, horizon, eps, levels)
+        da_V = read(model, 'V', reference_datetime, perturbed, horizon, eps, levels)
+
+    with timed('remap', stages):
+        destination_U, indices_U, weights_U, lon_U, lat_U, operator_U = get_delauny(da_U)
+        destination_V, indices_V, weights_V, lon_V, lat_V, operator_V = get_delauny(da_V)
+
+        f_U = ensure_z(reproject_with_delauny(da_U, destination_U, indices_U, weights_U, lon_U, lat_U, operator_U))
+        f_V = ensure_z(reproject_with_delauny(da_V, destination_V, indices_V, weights_V, lon_V, lat_V, operator_V))
+
+    filenames = []
+    if zarr_output:
+        with timed('zarr', stages):
+            save_zarr(f_U, f_V, reference_datetime, horizon, model, perturbed, eps)
+        # The chunks of the horizon are somewhere in the store, the publish looks for
+        # changed files in all of it
+        filenames.append(f'{folder}/{get_zarr_filename(model, perturbed, eps)}')
+
+    if cube_output:
+        with timed('cube', stages):
+            save_cube(f_U, f_V, reference_datetime, horizon, model, perturbed, eps)
+
+    if xyz_tiles:
+        with timed('tiles', stages):
+            filenames += save_tiles(da_U, da_V, levels, reference_datetime, horizon, model, perturbed, eps)
+
+    save_frame = get_save_frame()
+    frames = len(levels)
+
+    if altitude_output:
+        with timed('altitudes', stages):
+            filenames += save_altitudes(f_U, f_V, reference_datetime, horizon, model, perturbed, eps, save_frame)
+        frames += len(altitudes_amsl) + len(altitudes_agl)
+
+    if png_atlas:
+        filename = f'{folder}/{get_atlas_filename(reference_datetime, horizon, model, perturbed, eps)}'
+        with timed('encode', stages):
+            filenames += save_atlas(f_U, f_V, levels, filename)
+        return frames, filenames
+
+    for z in levels:
+        filename = f'{folder}/{get_png_filename(reference_datetime, horizon, model, perturbed, eps, z)}'
+        with timed('encode', stages):
+            save_frame(f_U.sel(z=z), f_V.sel(z=z), filename)
+        filenames.append(filename)
+    return frames, filenames
+
+def get_ensemble_filename(reference_datetime, horizon, model, statistic, z, extension):
+    time_filename = int((reference_datetime + horizon).timestamp())
+    return f'{model.upper()}-{statistic}-Z{z}-{time_filename}-wind.{extension}'
+
+def get_ensemble_statistics(u, v):
+    # Over the members of (eps, z, y, x) arrays, for all levels at once
+    speed = np.hypot(u, v)
+    mean_u = u.mean(axis=0)
+    mean_v = v.mean(axis=0)
+    spread = speed.std(axis=0)
+    thresholds = np.asarray(wind_speed_thresholds, dtype=speed.dtype).reshape(-1, 1, 1, 1, 1)
+    probability = (speed[np.newaxis] > thresholds).mean(axis=1)
+    probability[:, np.isnan(spread)] = np.nan
+    return mean_u, mean_v, spread, probability
+
+def write_ensemble_horizon(reference_datetime, horizon, model, levels, stages):
+    folder = get_data_folder(model)
+    os.makedirs(folder, exist_ok=True)
+
+    levels = tuple(z_values if levels is None else levels)
+    print(f'Working on ensemble horizon={get_horizon_hours(horizon)}, z={levels[0]}..{levels[-1]}...')
+    with timed('decode', stages):
+        da_U = read_members(model, 'U', reference_datetime, horizon, levels)
+        da_V = read_members(model, 'V', reference_datetime, horizon, levels)
+
+    with timed('remap', stages):
+        # U and V of all members share the grid and thus the weights
+        destination, indices, weights, lon, lat, operator = get_delauny(da_U)
+        f_U = ensure_z(reproject_with_delauny(da_U, destination, indices, weights, lon, lat, operator)).transpose('eps', 'z', 'y', 'x')
+        f_V = ensure_z(reproject_with_delauny(da_V, destination, indices, weights, lon, lat, operator)).transpose('eps', 'z', 'y', 'x')
+
+    with timed('statistics', stages):
+        mean_U, mean_V, spread, probability = get_ensemble_statistics(f_U.values, f_V.values)
+
+    save_frame = get_save_frame()
+    filenames = []
+    for i, z in enumerate(levels):
+        with timed('encode', stages):
+            filename = f'{folder}/{get_png_filename(reference_datetime, horizon, model, False, 0, z)}'
+            save_frame(f_U.isel(eps=0, z=i), f_V.isel(eps=0, z=i), filename)
+            filenames.append(filename)
+            filename = f'{folder}/{get_ensemble_filename(reference_datetime, horizon, model, "MEAN", z, frame_codecs.get_codec(frame_codec).extension)}'
+            save_frame(xr.DataArray(mean_U[i]), xr.DataArray(mean_V[i]), filename)
+            filenames.append(filename)
+            filename = f'{folder}/{get_ensemble_filename(reference_datetime, horizon, model, "SPREAD", z, "tif")}'
+            save_geotiff(xr.DataArray(spread[i]), filename)
+            filenames.append(filename)
+            for threshold, p in zip(wind_speed_thresholds, probability[:, i]):
+                filename = f'{folder}/{get_ensemble_filename(reference_datetime, horizon, model, f"P{threshold}", z, "tif")}'
+                save_geotiff(xr.DataArray(p), filename)
+                filenames.append(filename)
+    return len(levels) * (3 + len(wind_speed_thresholds)), filenames
+
+def get_height_fields_folder(constants_filename):
+    with open(constants_filename, 'rb') as f:
+        digest = hashlib.file_digest(f, 'sha1')
+    destination = get_destination()
+    digest.update(repr([
+        destination.crs.to_string(),
+        destination.nx,
+        destination.ny,
+        destination.xmin,
+        destination.xmax,
+        destination.ymin,
+        destination.ymax,
+        list(z_values),
+    ]).encode())
+    return f'{height_fields_path}/{digest.hexdigest()[:16]}'
+
+def make_height_fields(model, zarr_filename=None, cube_folder=None):
+    constants_filename = get_constants_filename(model, 'vertical')
+    folder = get_height_fields_folder(constants_filename)
+
+    if os.path.exists(folder):
+        print(f'Reuse height fields {folder}...')
+    else:
+        print(f'Compute height fields {folder}...')
+        with decode_lock:
+            ds = grib_decoder.load(
+                source=data_source.FileDataSource(datafiles=[constants_filename]), 
+                request={"param": "HHL"}, 
+                geo_coords=geo_coords
+            )
+        hhl = ds["HHL"].squeeze(drop=True)
+        hfl = destagger(hhl, "z")
+
+        # All levels are remapped at once, the lowest half level of HHL is the surface
+        destination, indices, weights, lon, lat, operator = get_delauny(hfl)
+        projected = reproject_with_delauny(hfl, destination, indices, weights, lon, lat, operator)
+        surface = reproject_with_delauny(hhl.isel(z=-1), destination, indices, weights, lon, lat, operator)
+
+        # Written to a temporary folder first so that an interrupted run is not reused
+        tmp_folder = get_tmp_filename(folder)
+        os.makedirs(tmp_folder, exist_ok=True)
+        for z in z_values:
+            save_geotiff(projected.sel(z=z), f'{tmp_folder}/hfl-Z{z}.tif')
+        np.save(f'{tmp_folder}/hfl.npy', projected.transpose('z', 'y', 'x').values)
+        np.save(f'{tmp_folder}/surface.npy', surface.values)
+        try:
+            os.rename(tmp_folder, folder)
+        except OSError:
+            # Computed concurrently by the pipeline of a model with the same constants
+            shutil.rmtree(tmp_folder)
+
+    data_folder = get_data_folder(model)
+    os.makedirs(data_folder, exist_ok=True)
     for z in z_values:
-        if destination is None:
-            destination, indices, weights, lon, lat = get_delauny(hfl.sel(z=z))
-        projected = reproject_with_delauny(hfl.sel(z=z), destination, indices, weights, lon, lat)
-        save_geotiff(projected, f'{data_path}/hfl-Z{z}.tif')
+        filename = f'{data_folder}/hfl-Z{z}.tif'
+        if os.path.lexists(filename):
+            os.remove(filename)
+        link_or_copy(f'{folder}/hfl-Z{z}.tif', filename)
+
+    hfl = np.load(f'{folder}/hfl.npy')
+    if zarr_filename is not None:
+        zarr.open_group(zarr_filename, mode='r+')['hfl'][:] = hfl.astype(np.float32)
+    if cube_folder is not None:
+        cube = np.load(f'{cube_folder}/hfl.npy', mmap_mode='r+')
+        cube[:] = hfl
+        cube.flush()
+    if altitude_output:
+        make_vertical_weights(model, hfl.reshape(len(z_values), -1), np.load(f'{folder}/surface.npy').ravel())
+
+def get_available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def get_available_memory():
+    available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        pass
+    # Memory limit of the container, if any
+    try:
+        with open('/sys/fs/cgroup/memory.max') as f:
+            limit = f.read().strip()
+        with open('/sys/fs/cgroup/memory.current') as f:
+            used = int(f.read())
+        if limit != 'max':
+            available = min(available, int(limit) - used)
+    except (FileNotFoundError, ValueError):
+        pass
+    return available
+
+def get_level_ranges():
+    levels = tuple(z_values)
+    if png_atlas or altitude_output or zarr_output:
+        # These outputs need all levels of a horizon in the same task
+        return [levels]
+    return [levels[i:i + levels_per_task] for i in range(0, len(levels), levels_per_task)]
+
+def get_num_workers():
+    cpus = get_available_cpus()
+    memory = get_available_memory()
+    members = max(ensemble_members.values()) if ensemble_output else 1
+    task_memory = task_base_memory + task_level_memory * members * max(len(r) for r in get_level_ranges())
+    num_workers = max(1, min(cpus, memory // task_memory))
+    if max_workers is not None:
+        num_workers = min(num_workers, max_workers)
+    print(f'{cpus} CPUs, {memory / 2**30:.1f} GiB available, {task_memory / 2**30:.2f} GiB per task: {num_workers} workers')
+    return num_workers
+
+def start_worker():
+    return os.getpid()
+
+def start_workers(executor, num_workers):
+    # The pool forks its workers on the first submit. Once download, discovery or
+    # other pipeline threads run, a worker could inherit a lock they hold (eccodes,
+    # GDAL, HTTP connection pools) and hang, so they are forked before any thread
+    # starts. Being forked, they still inherit the configuration of this module.
+    for future in [executor.submit(start_worker) for _ in range(num_workers)]:
+        future.result()
+
+class Scheduler:
+    """Hands the tasks of the pipelines of several models to one process pool.
+
+    A pipeline waiting for a slot is only served when no pipeline of a higher
+    priority (lower number) is waiting as well. Priority 0 may queue
+    pipeline_tasks_per_worker tasks per worker, the other priorities only fill
+    the pool up to one task per worker, so that a new run of the first model
+    never waits behind a long backlog of another model.
+    """
+
+    def __init__(self, executor, num_workers):
+        self.executor = executor
+        self.num_workers = num_workers
+        self.in_flight = 0
+        self.waiting = collections.Counter()
+        self.condition = threading.Condition()
+
+    def is_free(self, priority):
+        if any(self.waiting[p] for p in range(priority)):
+            return False
+        tasks_per_worker = pipeline_tasks_per_worker if priority == 0 else 1
+        return self.in_flight < self.num_workers * tasks_per_worker
+
+    def submit(self, priority, fn, *args):
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                self.condition.wait_for(lambda: self.is_free(priority))
+            finally:
+                self.waiting[priority] -= 1
+                # Lower priorities may have been held back only by this waiter
+                self.condition.notify_all()
+            self.in_flight += 1
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.release(None)
+            raise
+        future.add_done_callback(self.release)
+        return future
+
+    def release(self, future):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+def run_pipeline(reference_datetime, horizons, model, perturbed, eps, num_workers, on_complete=None, scheduler=None,
+                 priority=0):
+    # Without a scheduler, the pipeline runs in a process pool of its own
+    tic = time.perf_counter()
+    # ogd_api.download_from_ogd also fetches the horizontal and vertical constants
+    # which are needed by make_height_fields
+    os.makedirs(get_cache_folder(model), exist_ok=True)
+    with timed('download_constants', model=model):
+        download(model, 'U', reference_datetime, perturbed, horizons[0])
+    with timed('geo_coords', model=model):
+        save_geo_coords(model)
+
+    ready = queue.Queue(maxsize=pipeline_queue_size)
+    stop = threading.Event()
+    assets = get_assets(perturbed)
+    missing_variables = {horizon: set(assets) for horizon in horizons}
+    missing_variables_lock = threading.Lock()
+
+    def put_ready(horizon, error):
+        # Blocks while the queue is full, unless the pipeline was aborted
+        while not stop.is_set():
+            try:
+                ready.put((horizon, error), timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def fetch(variable, asset_perturbed, horizon):
+        if stop.is_set():
+            return
+        try:
+            download_asset(model, variable, reference_datetime, asset_perturbed, horizon)
+        except Exception as e:
+            put_ready(horizon, e)
+            return
+        with missing_variables_lock:
+            missing_variables[horizon].discard((variable, asset_perturbed))
+            complete = not missing_variables[horizon]
+        if complete:
+            put_ready(horizon, None)
+
+    with ThreadPoolExecutor(max_workers=download_workers) as downloader, \
+            ProcessPoolExecutor(max_workers=num_workers) if scheduler is None else nullcontext() as executor:
+        if scheduler is None:
+            start_workers(executor, num_workers)
+            scheduler = Scheduler(executor, num_workers)
+        try:
+            for horizon in horizons:
+                for variable, asset_perturbed in assets:
+                    downloader.submit(fetch, variable, asset_perturbed, horizon)
+
+            # Runs in this process while the downloads continue, so that the remap
+            # weights are cached before the first horizon is processed
+            zarr_filename = create_zarr_store(reference_datetime, model, perturbed, eps) if zarr_output else None
+            cube_folder = create_cube(reference_datetime, model, perturbed, eps) if cube_output else None
+            print('Make height fields...')
+            with timed('height_fields', model=model):
+                make_height_fields(model, zarr_filename, cube_folder)
+
+            level_ranges = get_level_ranges()
+            future_to_horizon = {}
+            remaining_tasks = {}
+            horizon_files = collections.defaultdict(list)
+
+            def collect(futures):
+                for future in futures:
+                    horizon = future_to_horizon.pop(future)
+                    task = future.result()
+                    record_task(model, task)
+                    horizon_files[horizon] += task['files']
+                    remaining_tasks[horizon] -= 1
+                    if remaining_tasks[horizon] > 0:
+                        continue
+                    print(f'Completed: horizon={get_horizon_hours(horizon)}')
+                    if cube_folder is not None:
+                        publish_cube_horizon(cube_folder, horizon, model, perturbed, eps)
+                    if on_complete is not None:
+                        # The files written for the horizon, relative to the data folder
+                        on_complete(horizon, horizon_files.pop(horizon))
+
+            for _ in horizons:
+                horizon, error = ready.get()
+                if error is not None:
+                    raise error
+                print(f'Submit horizon={get_horizon_hours(horizon)} in {len(level_ranges)} tasks...')
+                remaining_tasks[horizon] = len(level_ranges)
+                for levels in level_ranges:
+                    # Blocks until the scheduler has a free slot for this model
+                    future = scheduler.submit(priority, make_horizon, reference_datetime, horizon, model, perturbed, eps, levels)
+                    future_to_horizon[future] = horizon
+                    collect([f for f in list(future_to_horizon) if f.done()])
+
+            collect(list(as_completed(future_to_horizon)))
+        finally:
+            stop.set()
+    add_run_metric(model, 'pipeline_seconds', time.perf_counter() - tic)
 
 def delete_all_files_in_folder(folder):
     if not os.path.exists(folder):
         return
     for filename in os.listdir(folder):
         file_path = os.path.join(folder, filename)
-        if os.path.isfile(file_path):
-            try:
+        try:
+            if os.path.isfile(file_path):
                 os.remove(file_path)
-            except OSError as e:
-                print(f"Could not remove {file_path}: {e}")
-
-def copy_all_files(src_folder, dst_folder):
-    print(f'Copy files from {src_folder} to {dst_folder}...')
-    os.makedirs(dst_folder, exist_ok=True)
-    
-    if not os.path.exists(src_folder):
-        print(f"Source folder {src_folder} does not exist")
-        return
-    
-    for filename in os.listdir(src_folder):
-        src_file = os.path.join(src_folder, filename)
-        dst_file = os.path.join(dst_folder, filename)
-        
-        if os.path.isfile(src_file):
-            try:
-                shutil.copy2(src_file, dst_file)
-                print(f'Copied {src_file} to {dst_file}.')
-            except IOError as e:
-                print(f"Could not copy {src_file} to {dst_file}: {e}")
+            elif os.path.isdir(file_path):
+                shutil.rmtree(file_path)
+        except OSError as e:
+            print(f"Could not remove {file_path}: {e}")
 
-if __name__ == "__main__":
-    while True:
-        tic = time.time()
+def link_or_copy(src_file, dst_file):
+    try:
+        os.link(src_file, dst_file)
+    except OSError:
+        shutil.copy2(src_file, dst_file)
 
-        print('Successful API calls', successful_api_calls)
-        print('Failed API calls', failed_api_calls)
+def is_published(src_file, live_file):
+    # Frames are written once, hardlinks and copy2 keep the size and modification
+    # time of the source, so the contents need not be compared
+    try:
+        if os.path.samefile(src_file, live_file):
+            return True
+        src_stat = os.stat(src_file)
+        live_stat = os.stat(live_file)
+    except FileNotFoundError:
+        return False
+    return (src_stat.st_size, src_stat.st_mtime_ns) == (live_stat.st_size, live_stat.st_mtime_ns)
+
+def remove_old_publishes(runs_folder, keep):
+    publishes = sorted(
+        (name for name in os.listdir(runs_folder) if name.isdigit()),
+        key=int,
+    )
+    for name in publishes[:-keep]:
+        print(f'Remove old publish {runs_folder}/{name}...')
+        shutil.rmtree(os.path.join(runs_folder, name), ignore_errors=True)
+
+def publish(src_folder, dst_folder, runs_folder):
+    live = os.path.normpath(dst_folder)
+    staging = f'{runs_folder}/{time.time_ns()}'
+    print(f'Publish files from {src_folder} to {staging}...')
+    os.makedirs(staging)
+
+    for root, _, filenames in os.walk(src_folder):
+        folder = os.path.relpath(root, src_folder)
+        os.makedirs(os.path.join(staging, folder), exist_ok=True)
+        for filename in filenames:
+            if filename.endswith('.tmp'):
+                # Still being written by a worker
+                continue
+            src_file = os.path.join(root, filename)
+            # Files unchanged since the last publish, such as the height fields, are
+            # linked to the live copy instead of being written again
+            live_file = os.path.join(live, folder, filename)
+            if is_published(src_file, live_file):
+                src_file = live_file
+            link_or_copy(src_file, os.path.join(staging, folder, filename))
+
+    if os.path.isdir(live) and not os.path.islink(live):
+        # Plain directory from before publishes were switched atomically
+        os.rename(live, f'{runs_folder}/{time.time_ns()}')
 
-        last_run = ''
+    swap_symlink(os.path.relpath(staging, os.path.dirname(live)), live)
+    print(f'Published {staging}.')
+
+    threading.Thread(target=remove_old_publishes, args=(runs_folder, publish_keep), daemon=True).start()
+
+def publish_model(model):
+    live_root = os.path.normpath(data_copy_path)
+    if os.path.islink(live_root):
+        # Single live symlink from before the models were published separately
         try:
-            with open('data/last_run.json') as f:
-                last_run = json.load(f)['last_run']
+            os.remove(live_root)
         except FileNotFoundError:
             pass
+    os.makedirs(live_root, exist_ok=True)
+    publish(get_data_folder(model), f'{live_root}/{model}', f'{publish_path}/{model}')
 
-        model = 'ch1'
-        perturbed = False
-        eps = 0
+def publish_files(src_folder, dst_folder, filenames):
+    # Adds files of src_folder to the live publish in place, each of them replaced
+    # atomically. Folders among filenames, such as the Zarr store, are walked and
+    # only their files changed since the last publish are linked.
+    live = os.path.realpath(dst_folder)
+
+    def publish_file(filename):
+        src_file = os.path.join(src_folder, filename)
+        live_file = os.path.join(live, filename)
+        if is_published(src_file, live_file):
+            return
+        os.makedirs(os.path.dirname(live_file), exist_ok=True)
+        tmp_filename = get_tmp_filename(live_file)
+        link_or_copy(src_file, tmp_filename)
+        os.replace(tmp_filename, live_file)
 
-        reference_datetime = get_latest_completed_reference_datetime(model) # 2025-06-28 09:00:00+00:00
-        
-        latest_available_run = int(reference_datetime.timestamp())
+    for filename in filenames:
+        if not os.path.isdir(os.path.join(src_folder, filename)):
+            publish_file(filename)
+            continue
+        for root, _, names in os.walk(os.path.join(src_folder, filename)):
+            for name in names:
+                if not name.endswith('.tmp'):
+                    publish_file(os.path.relpath(os.path.join(root, name), src_folder))
+    print(f'Published {len(filenames)} files to {live}.')
+
+def read_published_manifest(model):
+    try:
+        with open(f'{os.path.normpath(data_copy_path)}/{model}/last_run.json') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
 
-        if last_run == latest_available_run:
+def read_manifest(model):
+    try:
+        with open(f'{get_data_folder(model)}/last_run.json') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def write_manifest(model, manifest):
+    folder = get_data_folder(model)
+    os.makedirs(folder, exist_ok=True)
+    # The old file may be hardlinked into a published directory
+    replace_atomically(f'{folder}/last_run.json', lambda f: json.dump(manifest, f), mode='w')
+
+# Processes and publishes the horizons of the latest run that appeared since the
+# last call, returns False if there was nothing new
+def run_incremental(model, perturbed, eps, num_workers, scheduler=None, priority=0):
+    tic = time.time()
+    reset_metrics(model)
+    with timed('discovery', model=model):
+        reference_datetime = get_latest_started_reference_datetime(model)
+    if reference_datetime is None:
+        return False
+
+    manifest = read_manifest(model)
+    run = int(reference_datetime.timestamp())
+    if manifest.get('last_run') != run or 'horizons' not in manifest:
+        print(f'Found new {model} run {reference_datetime}...')
+        delete_all_files_in_folder(get_data_folder(model))
+        delete_all_files_in_folder(get_cache_folder(model))
+        manifest = {'last_run': run, 'completed': False, 'horizons': []}
+    if manifest['completed']:
+        return False
+
+    all_horizons = get_horizons(model)
+    missing_horizons = [h for h in all_horizons if get_horizon_hours(h) not in manifest['horizons']]
+    with timed('discovery', model=model):
+        horizons = get_available_horizons(model, reference_datetime, perturbed, missing_horizons)
+    if not horizons:
+        return False
+
+    def publish_horizon(horizon, filenames):
+        manifest['horizons'] = sorted(manifest['horizons'] + [get_horizon_hours(horizon)])
+        manifest['completed'] = len(manifest['horizons']) == len(all_horizons)
+        write_manifest(model, manifest)
+        with timed('publish', model=model):
+            if read_published_manifest(model).get('last_run') == run:
+                # Only the files of the horizon are added to the live publish of
+                # the run, the manifest last so that clients never see a horizon
+                # before all of its files
+                publish_files(get_data_folder(model), f'{os.path.normpath(data_copy_path)}/{model}',
+                              filenames + ['last_run.json'])
+            else:
+                # First horizon of the run, or the live publish is of another run
+                publish_model(model)
+        write_metrics(model, reference_datetime, time.time() - tic)
+        print(f'Published {model} horizon={get_horizon_hours(horizon)}, {len(manifest["horizons"])}/{len(all_horizons)} available')
+
+    print(f'Starting {model} pipeline for {len(horizons)} new horizons with {num_workers} processes...')
+    run_pipeline(reference_datetime, horizons, model, perturbed, eps, num_workers, on_complete=publish_horizon,
+                 scheduler=scheduler, priority=priority)
+    write_metrics(model, reference_datetime, time.time() - tic)
+
+    if manifest['completed']:
+        delete_all_files_in_folder(get_cache_folder(model))
+    return True
+
+# Processes and publishes the latest completed run if it is newer than the last
+# one, returns False if there was nothing new
+def run_latest(model, perturbed, eps, num_workers, scheduler=None, priority=0):
+    tic = time.time()
+    last_run = read_manifest(model).get('last_run', '')
+
+    reset_metrics(model)
+    with timed('discovery', model=model):
+        reference_datetime = get_latest_completed_reference_datetime(model, perturbed) # 2025-06-28 09:00:00+00:00
+
+    latest_available_run = int(reference_datetime.timestamp())
+
+    if last_run == latest_available_run:
+        return False
+
+    print(f'Found new {model} run {reference_datetime}...')
+    delete_all_files_in_folder(get_data_folder(model))
+
+    horizons = get_horizons(model)
+
+    print(f"Starting {model} pipeline with {num_workers} processes...")
+    run_pipeline(reference_datetime, horizons, model, perturbed, eps, num_workers, scheduler=scheduler, priority=priority)
+
+    write_manifest(model, {
+        "last_run": latest_available_run,
+        "completed": True,
+        "horizons": [get_horizon_hours(horizon) for horizon in horizons],
+    })
+    with timed('publish', model=model):
+        publish_model(model)
+    write_metrics(model, reference_datetime, time.time() - tic)
+    delete_all_files_in_folder(get_cache_folder(model))
+
+    print(f'Finished {model} in {(time.time() - tic) / 60:.2f} min')
+    return True
+
+def run_model(model, priority, num_workers, scheduler):
+    perturbed = False
+    eps = 0
+    while True:
+        print('Successful API calls', successful_api_calls)
+        print('Failed API calls', failed_api_calls)
+
+        if incremental:
+            found = run_incremental(model, perturbed, eps, num_workers, scheduler, priority)
+        else:
+            found = run_latest(model, perturbed, eps, num_workers, scheduler, priority)
+
+        if not found:
             sleep_min = 1
-            print(f'No new run available. Sleep for {sleep_min} min...')
+            print(f'No new {model} data available. Sleep for {sleep_min} min...')
             time.sleep(sleep_min * 60)
-            continue
-        
-        print(f'Found new run {reference_datetime}...')
-        delete_all_files_in_folder(data_path)
-        
-        horizons = get_horizons(model)
-
-        for horizon in horizons:
-            download(model, 'U', reference_datetime, perturbed, horizon)
-            download(model, 'V', reference_datetime, perturbed, horizon)
-
-        print('Make height fields...')
-        make_height_fields()
-
-        num_threads = 8
-        print(f"Starting parallel tasks with {num_threads} threads...")
-        with ProcessPoolExecutor(max_workers=num_threads) as executor:
-            future_to_horizon = {
-                executor.submit(make_horizon, reference_datetime, horizon, model, perturbed, eps): horizon 
-                for horizon in horizons
-            }
-            
-            for future in as_completed(future_to_horizon):
-                horizon = future_to_horizon[future]
-                result = future.result()
-                print(f"Completed: {result}")
-                
-        with open('data/last_run.json', 'w') as f:
-            json.dump({"last_run": latest_available_run}, f)
-        copy_all_files(data_path, data_copy_path)
-        delete_all_files_in_folder(cache_path)
-
-        print(f'Finished in {(time.time() - tic) / 60:.2f} min')
+
+if __name__ == "__main__":
+    # The pool is shared by all models for the lifetime of the process, so the
+    # workers also keep their remap weights and coordinates across runs
+    num_workers = get_num_workers()
+    errors = queue.Queue()
+
+    def run_model_thread(model, priority, scheduler):
+        try:
+            run_model(model, priority, num_workers, scheduler)
+        except BaseException as e:
+            errors.put(e)
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        start_workers(executor, num_workers)
+        scheduler = Scheduler(executor, num_workers)
+        for priority, model in enumerate(models):
+            threading.Thread(target=run_model_thread, args=(model, priority, scheduler), daemon=True).start()
+        # A failed model stops the process, like a failed run did before
+        raise errors.get()
@@ -0,0 +1,209 @@
+"""Encoders and decoders for the wind frames of extract.py.
+
+Every codec stores U and V of one frame, given in m/s on the destination grid with
+rows from south to north and NaN outside the ICON domain. Decoding returns the
+same orientation with the values quantized by the codec:
+
+    png         RGBA PNG read by the web map, R and G hold U and V in km/h + 128,
+                B is zero and alpha the NaN mask
+    webp        the same RGBA pixels as lossless WebP, through the GDAL driver
+    u8.zst      raw (2, ny, nx) uint8 grids in km/h + 128 like the PNG, rounded
+    u16.zst     raw (2, ny, nx) uint16 grids in steps of 0.01 m/s
+    u8.zlib     the uint8 grids with zlib, which browsers inflate natively
+    u16.zlib    the uint16 grids with zlib
+
+The raw grids are stored north up like the images, after a header with the
+quantization, and 0 marks NaN. Before compression, each row is replaced by its
+difference to the row above, like the up filter of PNG. See
+benchmarks/bench_codecs.py for the size and speed of every codec.
+"""
+
+import collections
+import struct
+import zlib
+
+import numpy as np
+from rasterio.io import MemoryFile
+
+try:
+    from numcodecs import Zstd
+except ImportError:
+    Zstd = None
+
+shift = 128
+ms_to_kmh = 3.6
+
+zstd_level = 9
+zlib_level = 6
+# Compression of the png codec, extract.py passes its own settings to encode_png
+png_level = 6
+png_strategy = zlib.Z_RLE
+# PNG scanline filter: 0 none, 1 sub, 2 up
+png_filter = 2
+# Row filter of the raw grids: 0 none, 2 up
+raw_filter = 2
+
+# Magic, version, bytes per value, filter, ny, nx, scale, offset
+raw_header = struct.Struct('<4sBBBxIIff')
+raw_magic = b'LLWF'
+raw_version = 1
+# Stored value = round(value * scale + offset) for values in m/s
+raw_quantization = {
+    1: (ms_to_kmh, shift),
+    2: (100.0, 32768),
+}
+
+Codec = collections.namedtuple('Codec', ['extension', 'encode', 'decode'])
+
+codecs = {}
+
+def register(name, extension, encode, decode):
+    codecs[name] = Codec(extension, encode, decode)
+
+def get_codec(name):
+    if name not in codecs:
+        raise ValueError(f'Unknown frame codec {name}, available: {", ".join(codecs)}')
+    return codecs[name]
+
+def encode(name, u, v):
+    return get_codec(name).encode(np.asarray(u), np.asarray(v))
+
+def decode(name, data):
+    return get_codec(name).decode(data)
+
+def fill_rgba(u, v, pixels, tmp):
+    # Pixels of the PNG frames as (row, column, band) in the orientation of u and v
+    nan = np.isnan(u)
+    for band, values in [(0, u), (1, v)]:
+        np.multiply(values, ms_to_kmh, out=tmp)
+        np.add(tmp, shift, out=tmp)
+        tmp[np.isnan(tmp)] = 0
+        pixels[:, :, band] = tmp
+    pixels[:, :, 2] = 0
+    pixels[:, :, 3] = 255
+    pixels[:, :, 3][nan] = 0
+
+def get_rgba(u, v):
+    # Pixels of the PNG frames as (band, row, column), north up
+    u = np.asarray(u)[::-1]
+    v = np.asarray(v)[::-1]
+    pixels = np.empty(u.shape + (4,), dtype=np.uint8)
+    fill_rgba(u, v, pixels, np.empty(u.shape))
+    return pixels.transpose(2, 0, 1)
+
+# Scanline buffers reused across frames, keyed by frame shape
+png_buffers = {}
+
+def png_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+def encode_png(u, v, level=png_level, strategy=png_strategy, filter_type=png_filter):
+    u = np.asarray(u)[::-1]
+    v = np.asarray(v)[::-1]
+    height, width = u.shape
+
+    if u.shape not in png_buffers:
+        png_buffers[u.shape] = (
+            np.empty((height, 1 + 4 * width), dtype=np.uint8),
+            np.empty((height, width), dtype=np.float64),
+        )
+    scanlines, tmp = png_buffers[u.shape]
+    fill_rgba(u, v, scanlines[:, 1:].reshape(height, width, 4), tmp)
+
+    # Filters work on bytes modulo 256 and are applied in place from the last
+    # row or pixel backwards
+    data = scanlines[:, 1:]
+    if filter_type == 1:
+        data[:, 4:] -= data[:, :-4]
+    elif filter_type == 2:
+        data[1:] -= data[:-1]
+    elif filter_type != 0:
+        raise ValueError(f'Unsupported PNG filter type {filter_type}')
+    scanlines[:, 0] = filter_type
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, 9, strategy)
+    idat = compressor.compress(scanlines.tobytes()) + compressor.flush()
+
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)),
+        png_chunk(b'IDAT', idat),
+        png_chunk(b'IEND', b''),
+    ])
+
+def decode_rgba(data):
+    # PNG and WebP, the driver is detected from the data
+    with MemoryFile(data) as memfile, memfile.open() as src:
+        rgba = src.read()[:, ::-1]
+    # WebP leaves out the alpha band of frames without NaN
+    nan = rgba[3] == 0 if len(rgba) == 4 else np.zeros(rgba.shape[1:], dtype=bool)
+    u = (rgba[0] - np.float32(shift)) / np.float32(ms_to_kmh)
+    v = (rgba[1] - np.float32(shift)) / np.float32(ms_to_kmh)
+    u[nan] = np.nan
+    v[nan] = np.nan
+    return u, v
+
+def encode_webp(u, v):
+    rgba = get_rgba(u, v)
+    with MemoryFile() as memfile:
+        # Lossless for all visible pixels, the color under alpha 0 may be dropped
+        with memfile.open(driver='WEBP', height=rgba.shape[1], width=rgba.shape[2], count=4, dtype=np.uint8,
+                          LOSSLESS=True) as dst:
+            dst.write(rgba)
+        return memfile.read()
+
+def quantize(values, itemsize):
+    scale, offset = raw_quantization[itemsize]
+    maximum = 2 ** (8 * itemsize) - 1
+    stored = np.rint(values * scale + offset)
+    # 0 is reserved for NaN
+    np.clip(stored, 1, maximum, out=stored)
+    stored[np.isnan(values)] = 0
+    return stored.astype(f'<u{itemsize}')
+
+def encode_raw(u, v, itemsize, compress):
+    grids = np.stack([quantize(u, itemsize), quantize(v, itemsize)])[:, ::-1]
+    if raw_filter == 2:
+        # Modulo 2**bits like the PNG filters, undone by a cumulative sum
+        grids[:, 1:] -= grids[:, :-1].copy()
+    elif raw_filter != 0:
+        raise ValueError(f'Unsupported raw filter type {raw_filter}')
+
+    scale, offset = raw_quantization[itemsize]
+    ny, nx = u.shape
+    header = raw_header.pack(raw_magic, raw_version, itemsize, raw_filter, ny, nx, scale, offset)
+    return header + compress(np.ascontiguousarray(grids).tobytes())
+
+def decode_raw(data, decompress):
+    magic, version, itemsize, filter_type, ny, nx, scale, offset = raw_header.unpack_from(data)
+    if magic != raw_magic or version != raw_version:
+        raise ValueError('Not a raw wind frame')
+
+    grids = np.frombuffer(decompress(data[raw_header.size:]), dtype=f'<u{itemsize}').reshape(2, ny, nx)
+    if filter_type == 2:
+        grids = np.cumsum(grids, axis=1, dtype=grids.dtype)
+
+    nan = grids == 0
+    values = (grids[:, ::-1] - np.float32(offset)) / np.float32(scale)
+    values[nan[:, ::-1]] = np.nan
+    return values[0], values[1]
+
+def zstd_compress(data):
+    if Zstd is None:
+        raise ImportError('The zstd frame codecs require the numcodecs package')
+    return bytes(Zstd(level=zstd_level).encode(data))
+
+def zstd_decompress(data):
+    if Zstd is None:
+        raise ImportError('The zstd frame codecs require the numcodecs package')
+    return bytes(Zstd().decode(data))
+
+def zlib_compress(data):
+    return zlib.compress(data, zlib_level)
+
+register('png', 'png', lambda u, v: encode_png(u, v, png_level, png_strategy, png_filter), decode_rgba)
+register('webp', 'webp', encode_webp, decode_rgba)
+register('u8.zst', 'u8.zst', lambda u, v: encode_raw(u, v, 1, zstd_compress), lambda data: decode_raw(data, zstd_decompress))
+register('u16.zst', 'u16.zst', lambda u, v: encode_raw(u, v, 2, zstd_compress), lambda data: decode_raw(data, zstd_decompress))
+register('u8.zlib', 'u8.zlib', lambda u, v: encode_raw(u, v, 1, zlib_compress), lambda data: decode_raw(data, zlib.decompress))
+register('u16.zlib', 'u16.zlib', lambda u, v: encode_raw(u, v, 2, zlib_compress), lambda data: decode_raw(data, zlib.decompress))
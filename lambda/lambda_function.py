@@ -1,16 +1,38 @@
 import json
+import os
 import boto3
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from io import BytesIO
 
 from meteodatalab import ogd_api
 from earthkit.data import config
-from meteodatalab.operators import regrid
+# regrid.py of this repository, packaged next to this file by lambda/package.py. It
+# extends the regrid operators of meteodatalab with the sparse remap operator used by
+# extract.py.
+import regrid
 
 import rasterio
 from rasterio.crs import CRS
 from rasterio.enums import ColorInterp
 import numpy as np
+import xarray as xr
+
+# Remap weights of the destination grid, as written by extract.py to
+# remap-weights/delauny-<digest>.npz together with the UUID of their ICON grid.
+# Packaged next to this file or stored in the bucket under REMAP_WEIGHTS_KEY.
+# Without them, every level is remapped with regrid.iconremap, which triangulates
+# the source grid on every call.
+REMAP_WEIGHTS_FILE = os.environ.get(
+    'REMAP_WEIGHTS_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'remap-weights.npz')
+)
+REMAP_WEIGHTS_KEY = os.environ.get('REMAP_WEIGHTS_KEY')
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 8))
+
+# Kept at module scope, so that warm invocations skip loading the weights and
+# building the remap operator
+remap_cache = {}
+processor = None
 
 
 class WeatherDataProcessor:
@@ -132,12 +154,55 @@ class WeatherDataProcessor:
                     ExtraArgs={'ContentType': 'image/png'}
                 )
     
-    def process_level(self, da_U, da_V, level, eps, model, perturbed, reference_datetime, horizon):
+    def _read_remap_weights(self, f):
+        if 'uuid' not in f.files:
+            raise ValueError('Remap weights without grid UUID, recreate them with the current extract.py')
+        return {'indices': f['indices'], 'weights': f['weights'], 'uuid': str(f['uuid'])}
+    
+    def _load_remap_weights(self):
+        if 'weights' not in remap_cache:
+            if os.path.exists(REMAP_WEIGHTS_FILE):
+                print(f'Load remap weights {REMAP_WEIGHTS_FILE}...')
+                with np.load(REMAP_WEIGHTS_FILE) as f:
+                    remap_cache['weights'] = self._read_remap_weights(f)
+            elif REMAP_WEIGHTS_KEY:
+                print(f'Load remap weights s3://{self.bucket_name}/{REMAP_WEIGHTS_KEY}...')
+                with BytesIO() as buffer:
+                    self.s3_client.download_fileobj(self.bucket_name, REMAP_WEIGHTS_KEY, buffer)
+                    buffer.seek(0)
+                    with np.load(buffer) as f:
+                        remap_cache['weights'] = self._read_remap_weights(f)
+            else:
+                remap_cache['weights'] = None
+        return remap_cache['weights']
+    
+    def _get_remap_operator(self, uuid, ncells):
+        remap_weights = self._load_remap_weights()
+        # The weights of another grid, such as those of CH2 on CH1 data, would pass
+        # the shape checks and produce garbage frames
+        if remap_weights['uuid'] != str(uuid):
+            raise ValueError(f'Remap weights are for grid {remap_weights["uuid"]}, the data is on grid {uuid}')
+        if remap_weights['indices'].shape[0] != self.grid_config['nx'] * self.grid_config['ny']:
+            raise ValueError('Remap weights do not match the destination grid')
+        
+        key = ('operator', str(uuid), ncells)
+        if key not in remap_cache:
+            remap_cache[key] = regrid.remap_operator(remap_weights['indices'], remap_weights['weights'], ncells)
+        return remap_weights['indices'], remap_weights['weights'], remap_cache[key]
+    
+    def remap_levels(self, da_U, da_V, levels, eps):
+        # All levels of U and of V in one sparse product each
         destination = self._create_destination_grid()
+        indices, weights, operator = self._get_remap_operator(da_U.metadata.get('uuidOfHGrid'), da_U.sizes['cell'])
         
-        f_U = regrid.iconremap(da_U.isel(eps=eps, z=level), destination).squeeze()
-        f_V = regrid.iconremap(da_V.isel(eps=eps, z=level), destination).squeeze()
+        def remap(da):
+            field = regrid.icon2regular(da.isel(eps=eps, z=levels), destination, indices, weights, operator)
+            # The other dimensions of a single horizon have size one
+            return field.transpose(..., 'z', 'y', 'x').values.reshape(len(levels), destination.ny, destination.nx)
         
+        return remap(da_U), remap(da_V)
+    
+    def write_level(self, f_U, f_V, level, eps, model, perturbed, reference_datetime, horizon):
         alpha = self._create_alpha_channel(f_U)
         
         f_U = self._process_wind_values(f_U)
@@ -150,9 +215,30 @@ class WeatherDataProcessor:
         
         self._save_to_s3(rgba_flipped, filename, f_U.shape[0], f_U.shape[1])
     
+    def process_level(self, da_U, da_V, level, eps, model, perturbed, reference_datetime, horizon):
+        destination = self._create_destination_grid()
+        
+        f_U = regrid.iconremap(da_U.isel(eps=eps, z=level), destination).squeeze()
+        f_V = regrid.iconremap(da_V.isel(eps=eps, z=level), destination).squeeze()
+        
+        self.write_level(f_U, f_V, level, eps, model, perturbed, reference_datetime, horizon)
+    
     def process_levels(self, da_U, da_V, levels, eps, model, perturbed, reference_datetime, horizon):
-        for level in levels:
-            self.process_level(da_U, da_V, level, eps, model, perturbed, reference_datetime, horizon)
+        if self._load_remap_weights() is None:
+            for level in levels:
+                self.process_level(da_U, da_V, level, eps, model, perturbed, reference_datetime, horizon)
+            return
+        
+        f_U, f_V = self.remap_levels(da_U, da_V, levels, eps)
+        
+        # Encoding and uploads overlap, the S3 client is thread safe
+        def write(i):
+            self.write_level(
+                xr.DataArray(f_U[i]), xr.DataArray(f_V[i]), levels[i], eps, model, perturbed, reference_datetime, horizon
+            )
+        
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+            list(executor.map(write, range(len(levels))))
     
     def process_weather_data(self, reference_datetime, horizon, model, perturbed, eps, levels):
         collection = f'ogd-forecasting-icon-{model}'
@@ -160,6 +246,9 @@ class WeatherDataProcessor:
         req_U, req_V = self._create_ogd_requests(collection, reference_datetime, perturbed, horizon)
         da_U, da_V = self._fetch_wind_data(req_U, req_V)
         
+        if levels is None:
+            levels = list(range(da_U.sizes['z']))
+        
         self.process_levels(da_U, da_V, levels, eps, model, perturbed, reference_datetime, horizon)
 
 
@@ -194,9 +283,21 @@ class WeatherDataValidator:
         return reference_datetime
 
 
+def get_levels(event):
+    # 'levels' is a list of level indices or 'all', 'level' a single index
+    levels = event.get('levels')
+    if levels == 'all':
+        return None
+    if levels is not None:
+        return [int(level) for level in levels]
+    return [int(event.get('level', 0))]
+
+
 def lambda_handler(event, context):
+    global processor
     try:
-        processor = WeatherDataProcessor()
+        if processor is None:
+            processor = WeatherDataProcessor()
         validator = WeatherDataValidator()
         
         model = 'ch1'
@@ -205,7 +306,7 @@ def lambda_handler(event, context):
         
         reference_datetime = validator.find_latest_available_run(model, perturbed)
         horizon = timedelta(hours=0)
-        levels = [int(event.get('level', 0))]
+        levels = get_levels(event)
         
         processor.process_weather_data(reference_datetime, horizon, model, perturbed, eps, levels)
         
@@ -0,0 +1,40 @@
+"""Build the deployment package of the Lambda handler.
+
+The handler imports regrid.py from the root of this repository, which is packaged
+next to it together with the optional remap weights written by extract.py:
+
+    python lambda/package.py --weights remap-weights/delauny-<digest>.npz
+
+The dependencies (meteodatalab, rasterio, ...) come from the layer or image of the
+function as before.
+"""
+
+import argparse
+import os
+import zipfile
+
+lambda_folder = os.path.dirname(os.path.abspath(__file__))
+repository_folder = os.path.dirname(lambda_folder)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--weights', help='remap weights of the destination grid, packaged as remap-weights.npz')
+    parser.add_argument('--output', default=os.path.join(lambda_folder, 'lambda.zip'))
+    args = parser.parse_args()
+
+    files = {
+        'lambda_function.py': os.path.join(lambda_folder, 'lambda_function.py'),
+        'regrid.py': os.path.join(repository_folder, 'regrid.py'),
+    }
+    if args.weights:
+        files['remap-weights.npz'] = args.weights
+
+    with zipfile.ZipFile(args.output, 'w', zipfile.ZIP_DEFLATED) as f:
+        for name, filename in files.items():
+            f.write(filename, name)
+    print(f'Packaged {", ".join(files)} into {args.output}')
+
+
+if __name__ == '__main__':
+    main()
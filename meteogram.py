@@ -0,0 +1,146 @@
+"""Point query service for wind profiles from the forecast cube of extract.py.
+
+Serves the memory-mapped (time, z, y, x) cube written with cube_output = True:
+
+    python meteogram.py --port 8001
+    curl 'http://localhost:8001/profile?lat=46.8&lon=8.2&model=CH1&member=CTRL'
+
+The response holds U and V in m/s for every available time and level and the
+height of every level in m AMSL, all sampled bilinearly at the requested point.
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from pyproj import Transformer
+
+
+class Cube:
+    def __init__(self, folder):
+        with open(f'{folder}/index.json') as f:
+            self.index = json.load(f)
+        self.U = np.load(f'{folder}/U.npy', mmap_mode='r')
+        self.V = np.load(f'{folder}/V.npy', mmap_mode='r')
+        self.hfl = np.load(f'{folder}/hfl.npy', mmap_mode='r')
+        self.available = np.array(self.index['available'])
+        self.transformer = None
+        if self.index['crs'] != 'EPSG:4326':
+            self.transformer = Transformer.from_crs('epsg:4326', self.index['crs'], always_xy=True)
+
+    def profile(self, lat, lon):
+        index = self.index
+        x, y = (lon, lat) if self.transformer is None else self.transformer.transform(lon, lat)
+
+        # Fractional grid coordinates, the grid is stored south to north
+        fi = (x - index['xmin']) / (index['xmax'] - index['xmin']) * (index['nx'] - 1)
+        fj = (y - index['ymin']) / (index['ymax'] - index['ymin']) * (index['ny'] - 1)
+        if not (0 <= fi <= index['nx'] - 1 and 0 <= fj <= index['ny'] - 1):
+            return None
+
+        i = min(int(fi), index['nx'] - 2)
+        j = min(int(fj), index['ny'] - 2)
+        wx = fi - i
+        wy = fj - j
+        weights = np.array([[(1 - wy) * (1 - wx), (1 - wy) * wx], [wy * (1 - wx), wy * wx]])
+
+        def sample(cube):
+            return np.einsum('...ji,ji->...', cube[..., j:j + 2, i:i + 2], weights)
+
+        return {
+            'lat': lat,
+            'lon': lon,
+            'reference_datetime': index['reference_datetime'],
+            'time': [t for t, available in zip(index['time'], self.available) if available],
+            'z': index['z'],
+            'hfl': to_list(sample(self.hfl)),
+            'U': to_list(sample(self.U)[self.available]),
+            'V': to_list(sample(self.V)[self.available]),
+        }
+
+
+def to_list(values):
+    # JSON has no NaN, out of domain values become null
+    return np.where(np.isnan(values), None, np.round(values, 2)).tolist()
+
+
+class CubeCache:
+    """Open cubes by name, reopened when the pipeline publishes a new horizon or run."""
+
+    def __init__(self, cube_path):
+        self.cube_path = cube_path
+        self.cubes = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        folder = os.path.realpath(os.path.join(self.cube_path, name))
+        if os.path.dirname(folder) != os.path.realpath(self.cube_path):
+            return None
+        try:
+            key = (folder, os.stat(f'{folder}/index.json').st_mtime_ns)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if self.cubes.get(name, (None, None))[0] != key:
+                self.cubes[name] = (key, Cube(folder))
+            return self.cubes[name][1]
+
+
+def make_handler(cubes):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/profile':
+                return self.respond(404, {'error': 'Not found'})
+
+            query = parse_qs(url.query)
+            try:
+                lat = float(query['lat'][0])
+                lon = float(query['lon'][0])
+            except (KeyError, ValueError):
+                return self.respond(400, {'error': 'lat and lon are required'})
+            model = query.get('model', ['CH1'])[0].upper()
+            member = query.get('member', ['CTRL'])[0].upper()
+
+            cube = cubes.get(f'{model}-{member}')
+            if cube is None:
+                return self.respond(404, {'error': f'No forecast for {model}-{member}'})
+
+            tic = time.perf_counter()
+            profile = cube.profile(lat, lon)
+            if profile is None:
+                return self.respond(404, {'error': 'Point outside of the forecast domain'})
+            profile['elapsed_ms'] = (time.perf_counter() - tic) * 1e3
+            self.respond(200, profile)
+
+        def respond(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cube-path', default='cube')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(CubeCache(args.cube_path)))
+    print(f'Serving profiles from {args.cube_path} on http://{args.host}:{args.port}/profile')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
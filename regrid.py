@@ -39,6 +39,7 @@ try:
     from pyproj import Transformer
     from rasterio import transform, warp
     from rasterio.crs import CRS
+    from scipy import sparse  # type: ignore
     from scipy.spatial import Delaunay  # type: ignore
 except ImportError:
     raise ImportError("The regrid operator requires extra dependencies.")
@@ -392,24 +393,127 @@ def regrid(
     return xr.DataArray(data, attrs=attrs)
 
 
+def _inside_mask(indices: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """Mask of the destination points inside of the source domain.
+
+    Points outside of the source domain have index 0 and zero weights at all
+    vertices. The weights are checked as well, so that weights cached before the
+    indices of these points were reset to 0 are masked too.
+    """
+    return np.all(indices != 0, axis=-1) & np.any(weights != 0, axis=-1)
+
+
+def remap_operator(
+    indices: np.ndarray, weights: np.ndarray, ncells: int
+) -> sparse.csr_matrix:
+    """Build a sparse interpolation operator from remap indices and weights.
+
+    The weights of each destination point are clipped to be non-negative and
+    normalised to sum to one. Every destination value is then a convex combination
+    of its source values, which bounds it by their minimum and maximum in the same
+    way as the clipping in icon2regular. Rows of destination points outside of the
+    source domain are left empty, icon2regular sets them to NaN.
+
+    Parameters
+    ----------
+    indices : numpy.ndarray
+        Indices of the source cells, of shape (npts, nvertices).
+    weights : numpy.ndarray
+        Interpolation weights, of shape (npts, nvertices).
+    ncells : int
+        Number of cells in the source grid.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Interpolation operator of shape (npts, ncells).
+
+    """
+    npts, nvertices = indices.shape
+    mask = _inside_mask(indices, weights)
+
+    wgts = np.clip(weights, 0, None)
+    total = wgts.sum(axis=-1, keepdims=True)
+    wgts = np.divide(wgts, total, out=np.zeros_like(wgts), where=total > 0)
+    wgts[~mask] = 0
+
+    rows = np.repeat(np.arange(npts), nvertices)
+    operator = sparse.csr_matrix(
+        (wgts.ravel(), (rows, indices.ravel())), shape=(npts, ncells)
+    )
+    operator.eliminate_zeros()
+    return operator
+
+
+def _chunks(size: int, chunk_size: int | None) -> typing.Iterator[slice]:
+    step = max(1, chunk_size) if chunk_size else max(1, size)
+    for start in range(0, size, step):
+        yield slice(start, min(start + step, size))
+
+
 def icon2regular(
-    field: xr.DataArray, dst: RegularGrid, indices: np.ndarray, weights: np.ndarray
+    field: xr.DataArray,
+    dst: RegularGrid,
+    indices: np.ndarray,
+    weights: np.ndarray,
+    operator: sparse.csr_matrix | None = None,
+    chunk_size: int | None = None,
 ) -> xr.DataArray:
-    mask = np.all(indices != 0, axis=-1)
+    """Remap ICON native grid data to a regular grid with precomputed weights.
+
+    Parameters
+    ----------
+    field : xarray.DataArray
+        A field with data in the ICON native grid.
+    dst : RegularGrid
+        Destination grid of the indices and weights.
+    indices : numpy.ndarray
+        Indices of the source cells, of shape (npts, nvertices).
+    weights : numpy.ndarray
+        Interpolation weights, of shape (npts, nvertices).
+    operator : scipy.sparse.csr_matrix, optional
+        Interpolation operator built by remap_operator from the same indices and
+        weights. If given, the remap is a single sparse product per chunk.
+    chunk_size : int, optional
+        Number of destination points remapped at once. Temporary arrays scale with
+        the chunk rather than with the destination grid. Defaults to all points.
+
+    Returns
+    -------
+    xarray.DataArray
+        Field with data remapped to the destination grid.
+
+    """
+    npts = dst.nx * dst.ny
+    mask = _inside_mask(indices, weights)
 
     def reproject_layer(field):
         out_shape = field.shape[:-1] + (dst.ny, dst.nx)
-        values = np.take(field, indices, axis=-1)
-        if np.any(np.isnan(values)):
+        out = np.empty(field.shape[:-1] + (npts,), np.result_type(field, weights))
+        for chunk in _chunks(npts, chunk_size):
+            values = np.take(field, indices[chunk], axis=-1)
+            if np.any(np.isnan(values)):
+                warnings.warn("Interpolation of missing values is not supported.")
+            vmin = np.min(values, axis=-1)
+            vmax = np.max(values, axis=-1)
+            result = np.einsum("...ij,ij->...i", values, weights[chunk])
+            masked = np.where(mask[chunk], result, np.nan)
+            out[..., chunk] = np.clip(masked, vmin, vmax)
+        return out.reshape(out_shape)
+
+    def reproject_layer_sparse(field):
+        out_shape = field.shape[:-1] + (dst.ny, dst.nx)
+        stack = np.ascontiguousarray(field.reshape(-1, field.shape[-1]).T)
+        if np.any(np.isnan(stack)):
             warnings.warn("Interpolation of missing values is not supported.")
-        vmin = np.min(values, axis=-1)
-        vmax = np.max(values, axis=-1)
-        result = np.einsum("...ij,ij->...i", values, weights)
-        masked = np.where(mask, result, np.nan)
-        return np.clip(masked, vmin, vmax).reshape(out_shape)
+        out = np.empty((stack.shape[1], npts), np.result_type(stack, operator.dtype))
+        for chunk in _chunks(npts, chunk_size):
+            out[:, chunk] = (operator[chunk] @ stack).T
+        out[:, ~mask] = np.nan
+        return out.reshape(out_shape)
 
     data = xr.apply_ufunc(
-        reproject_layer,
+        reproject_layer if operator is None else reproject_layer_sparse,
         field,
         input_core_dims=[["cell"]],
         output_core_dims=[["y", "x"]],
@@ -499,7 +603,15 @@ def icon2rotlatlon(field: xr.DataArray) -> xr.DataArray:
 
 def _linear_weights(pts_src: ArrayLike, pts_dst: ArrayLike) -> tuple[NDArray, NDArray]:
     """Compute indices and weights for barycentric linear interpolation."""
-    tri = Delaunay(pts_src)
+    return _barycentric_weights(Delaunay(pts_src), pts_dst)
+
+
+def _barycentric_weights(tri: Delaunay, pts_dst: ArrayLike) -> tuple[NDArray, NDArray]:
+    """Compute indices and weights for barycentric linear interpolation.
+
+    Uses an existing triangulation of the source points, which allows to compute the
+    weights of the destination points in several chunks.
+    """
     simplex = tri.find_simplex(pts_dst)
     isfound = simplex != -1
     vertices = np.take(tri.simplices, simplex, axis=0)
@@ -535,7 +647,9 @@ def _linear_weights_cropped_domain(
     mask = (xmin < x) & (x < xmax) & (ymin < y) & (y < ymax)
     [idx] = np.nonzero(mask)
     indices, weights = _linear_weights(pts_src[idx], pts_dst)
-    return idx[indices], weights
+    # Points outside of the source domain keep index 0
+    isfound = np.any(indices != 0, axis=-1, keepdims=True)
+    return np.where(isfound, idx[indices], 0), weights
 
 
 def iconremap(
@@ -588,26 +702,78 @@ def iconremap(
     )
 
 def iconremap_delauny(
-    field: xr.DataArray, dst: RegularGrid, method: Literal["byc"] = "byc"
-) -> xr.DataArray:
+    field: xr.DataArray,
+    dst: RegularGrid,
+    method: Literal["byc"] = "byc",
+    chunk_size: int | None = None,
+) -> tuple[NDArray, NDArray, NDArray, NDArray]:
+    """Compute barycentric remap weights from ICON native grid to a regular grid.
+
+    The source grid is triangulated once, cropped to the destination grid with a
+    buffer. The destination points are then transformed and located in chunks of
+    whole rows, so that only the returned arrays scale with the destination grid.
+
+    Parameters
+    ----------
+    field : xarray.DataArray
+        A field with data in the ICON native grid.
+    dst : RegularGrid
+        A regular grid in any coordinate system.
+    method : Literal["byc"]
+        Method used to perform the interpolation.
+
+        Available methods:
+        - byc: Barycentric linear interpolation.
+    chunk_size : int, optional
+        Approximate number of destination points processed at once. Defaults to all
+        points.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        Indices and weights of shape (npts, 3), longitude and latitude of the
+        destination points of shape (ny, nx).
+
+    """
     if method not in {"byc"}:
         raise NotImplementedError(f"method: {method} is not implemented")
 
     utm_crs = "epsg:32632"  # UTM zone 32N
+    buffer = 4e3
 
     transformer_src = Transformer.from_crs("epsg:4326", utm_crs, always_xy=True)
     points_src = transformer_src.transform(field.lon, field.lat)
-
-    gx, gy = np.meshgrid(dst.x, dst.y)
-    transformer_dst = Transformer.from_crs(dst.crs.wkt, utm_crs, always_xy=True)
-    points_dst = transformer_dst.transform(gx.flat, gy.flat)
-
     xy = np.array(points_src).T
-    uv = np.array(points_dst).T
-
-    indices, weights = _linear_weights_cropped_domain(xy, uv)
 
+    transformer_dst = Transformer.from_crs(dst.crs.wkt, utm_crs, always_xy=True)
     transformer_geo = Transformer.from_crs(dst.crs.wkt, "epsg:4326", always_xy=True)
-    lon, lat = transformer_geo.transform(gx, gy)
+
+    # The extent of the destination grid is given by its outline
+    x, y = dst.x, dst.y
+    outline_x = np.concatenate([x, x, np.full_like(y, x[0]), np.full_like(y, x[-1])])
+    outline_y = np.concatenate([np.full_like(x, y[0]), np.full_like(x, y[-1]), y, y])
+    u, v = transformer_dst.transform(outline_x, outline_y)
+    umin, umax = np.min(u) - buffer, np.max(u) + buffer
+    vmin, vmax = np.min(v) - buffer, np.max(v) + buffer
+    mask = (umin < xy[:, 0]) & (xy[:, 0] < umax) & (vmin < xy[:, 1]) & (xy[:, 1] < vmax)
+    [idx] = np.nonzero(mask)
+    tri = Delaunay(xy[idx])
+
+    npts = dst.nx * dst.ny
+    indices = np.empty((npts, 3), dtype=idx.dtype)
+    weights = np.empty((npts, 3))
+    lon = np.empty((dst.ny, dst.nx))
+    lat = np.empty((dst.ny, dst.nx))
+
+    rows_per_chunk = max(1, (chunk_size or npts) // dst.nx)
+    for rows in _chunks(dst.ny, rows_per_chunk):
+        gx, gy = np.meshgrid(x, y[rows])
+        uv = np.array(transformer_dst.transform(gx.flat, gy.flat)).T
+        chunk = slice(rows.start * dst.nx, rows.stop * dst.nx)
+        chunk_indices, weights[chunk] = _barycentric_weights(tri, uv)
+        # Points outside of the source domain keep index 0
+        isfound = np.any(chunk_indices != 0, axis=-1, keepdims=True)
+        indices[chunk] = np.where(isfound, idx[chunk_indices], 0)
+        lon[rows], lat[rows] = transformer_geo.transform(gx, gy)
 
     return indices, weights, lon, lat
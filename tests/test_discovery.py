@@ -0,0 +1,57 @@
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import extract
+
+R0 = datetime(2026, 10, 18, 0, tzinfo=timezone.utc)
+R1 = datetime(2026, 10, 18, 3, tzinfo=timezone.utc)
+
+
+def stub_catalog(monkeypatch, catalog):
+    # catalog maps a horizon in hours to its latest reference datetime
+    def get_latest_reference_datetime(model, variable, perturbed, horizon):
+        return catalog.get(int(horizon / timedelta(hours=1)), R1)
+
+    monkeypatch.setattr(extract, 'get_latest_reference_datetime', get_latest_reference_datetime)
+    monkeypatch.setattr(extract, 'discovery_state', {})
+
+
+def test_lagging_horizon_is_not_cached(monkeypatch):
+    catalog = {20: R0}
+    stub_catalog(monkeypatch, catalog)
+
+    # The last horizon already has R1 while horizon 20 still has R0
+    assert extract.get_latest_completed_reference_datetime('ch1', False) == R0
+    assert 'ch1' not in extract.discovery_state
+
+    # Horizon 20 catches up, the last horizon does not change
+    del catalog[20]
+    assert extract.get_latest_completed_reference_datetime('ch1', False) == R1
+
+
+def test_consistent_catalog_is_cached(monkeypatch):
+    stub_catalog(monkeypatch, {})
+
+    assert extract.get_latest_completed_reference_datetime('ch1', False) == R1
+    assert extract.discovery_state['ch1'] == ([R1, R1], R1)
+
+    probes = []
+    monkeypatch.setattr(extract, 'get_latest_reference_datetime',
+                        lambda model, variable, perturbed, horizon: probes.append(horizon) or R1)
+    assert extract.get_latest_completed_reference_datetime('ch1', False) == R1
+    # Only U and V of the last horizon were probed
+    assert len(probes) == 2
+
+
+def test_ensemble_waits_for_perturbed_assets(monkeypatch):
+    monkeypatch.setattr(extract, 'ensemble_output', True)
+    monkeypatch.setattr(extract, 'discovery_state', {})
+    # The perturbed members of horizon 20 are published after the control run
+    monkeypatch.setattr(extract, 'get_latest_reference_datetime',
+                        lambda model, variable, perturbed, horizon: R0 if perturbed and horizon == timedelta(hours=20) else R1)
+
+    assert extract.get_latest_completed_reference_datetime('ch1', False) == R0
+    horizons = [timedelta(hours=h) for h in [19, 20, 21]]
+    assert extract.get_available_horizons('ch1', R1, False, horizons) == [horizons[0], horizons[2]]
@@ -0,0 +1,56 @@
+import os
+import sys
+
+import numpy as np
+import xarray as xr
+from rasterio.io import MemoryFile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import extract
+import frame_codecs
+import regrid
+
+# Source domain of the test grid, the zoom 5 tile (16, 11) reaches down to 40.98°N.
+# The first cell lies west of the tile, so that it is cropped away like in the ICON
+# grids and out-of-domain points cannot point at it by accident.
+lon_min, lon_max = -3.0, 12.0
+lat_min, lat_max = 42.0, 50.0
+
+
+def make_field(nx=240, ny=160, seed=0):
+    rng = np.random.default_rng(seed)
+    lon, lat = np.meshgrid(np.linspace(lon_min, lon_max, nx), np.linspace(lat_min, lat_max, ny))
+    lon = lon.ravel() + rng.uniform(-0.01, 0.01, lon.size)
+    lat = lat.ravel() + rng.uniform(-0.01, 0.01, lat.size)
+    values = 10 * np.sin(np.radians(lon) * 40)[None] * np.arange(1, 3)[:, None]
+    return xr.DataArray(
+        values,
+        dims=('z', 'cell'),
+        coords={'z': [1, 2], 'lon': ('cell', lon), 'lat': ('cell', lat)},
+    )
+
+
+def test_edge_tile_is_transparent_outside_of_the_domain(monkeypatch):
+    # The test field has no GRIB metadata to update
+    monkeypatch.setattr(regrid, '_get_metadata', lambda grid: {})
+    field = make_field()
+    destination = extract.get_tile_grid(16, 11, 5)
+    indices, weights, lon, lat = regrid.iconremap_delauny(field, destination)
+    operator = regrid.remap_operator(indices, weights, field.sizes['cell'])
+
+    sparse = regrid.icon2regular(field, destination, indices, weights, operator).values
+    dense = regrid.icon2regular(field, destination, indices, weights).values
+    np.testing.assert_allclose(sparse, dense, equal_nan=True)
+
+    nan = np.isnan(sparse[0])
+    assert nan.any() and not nan.all()
+    # Only pixels south of the source domain are NaN
+    assert np.all(lat[nan] < lat_min + 0.1)
+    assert not np.isnan(sparse[0][lat > lat_min + 0.1]).any()
+
+    data = frame_codecs.encode_png(sparse[0], sparse[1])
+    with MemoryFile(data) as memfile, memfile.open() as src:
+        rgba = src.read()[:, ::-1]
+    np.testing.assert_array_equal(rgba[3] == 0, nan)
+    assert np.all(rgba[:3, nan] == 0)
+